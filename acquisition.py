@@ -0,0 +1,195 @@
+import heapq
+import time
+
+from threading import Thread, Event
+from types import MappingProxyType
+from typing import Callable, Dict, Mapping, NamedTuple, Optional
+
+from bus_worker import BusWorker
+
+
+def now() -> float:
+    # clock used for every reading timestamp
+    return time.monotonic()
+
+
+class Reading(NamedTuple):
+    values: tuple
+    timestamp: float
+
+
+class Pending(NamedTuple):
+    """
+    returned by a read which is not finished yet, e.g. a conversion is running
+
+    the engine calls the read again at due and samples other devices meanwhile
+    """
+    due: float
+
+
+class Snapshot(NamedTuple):
+    """
+    immutable set of the latest readings of every device
+
+    a new snapshot is published after every sample, so readers never
+    have to lock anything
+    """
+    readings: Mapping[str, Reading]
+    errors: Mapping[str, int]
+    sequence: int
+
+    def get(self, name: str, default: Optional[tuple] = None) -> Optional[tuple]:
+        reading = self.readings.get(name)
+        if reading is None:
+            return default
+        return reading.values
+
+
+EMPTY_SNAPSHOT = Snapshot(MappingProxyType({}), MappingProxyType({}), 0)
+
+
+class _Device:
+
+    def __init__(self, name: str, read: Callable[[], tuple], rate: float,
+                 worker: Optional[BusWorker] = None, group: bool = False) -> None:
+        self.name = name
+        self.period = 1.0 / rate
+        # due time of the running cycle, the cadence is kept across Pending reads
+        self.cycle: Optional[float] = None
+        # group reads return {name: values} for several devices at once
+        self.group = group
+        if worker is None:
+            self.read = read
+        else:
+            self.read = lambda: worker.call(read)
+
+
+class AcquisitionEngine:
+    """
+    samples every registered device on its own cadence in a background thread
+
+    devices are scheduled from one thread, reads of devices registered with
+    a bus worker are executed on that worker so they never race other bus users
+    """
+
+    def __init__(self) -> None:
+        self.devices: Dict[str, _Device] = {}
+        self.snapshot: Snapshot = EMPTY_SNAPSHOT
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def add_device(self, name: str, read: Callable[[], tuple], rate: float,
+                   worker: Optional[BusWorker] = None) -> None:
+        """
+        :param name: key of the readings in the snapshot
+        :param read: callable returning a tuple of values, or None when the
+            device has no new sample since the last read
+        :param rate: sample rate in Hz
+        :param worker: owner of the bus the device sits on, read is executed there
+        """
+        if rate <= 0:
+            raise ValueError(f"Sample rate of \"{name}\" must be positive")
+        self.devices[name] = _Device(name, read, rate, worker)
+
+    def add_group(self, name: str, read: Callable[[], Mapping[str, tuple]], rate: float,
+                  worker: Optional[BusWorker] = None) -> None:
+        """
+        registers a callable sampling several devices at once (e.g. BusScheduler.step)
+
+        :param name: name of the group, used for error counters
+        :param read: callable returning {device name: tuple of values or Reading},
+            or Pending when it has to be called again later to finish the cycle
+        """
+        if rate <= 0:
+            raise ValueError(f"Sample rate of \"{name}\" must be positive")
+        self.devices[name] = _Device(name, read, rate, worker, group=True)
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name="acquisition", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        """
+        returns:
+            age in seconds and timestamp of the latest reading of every device
+            and read errors per device or group, a sensor which dropped off
+            the bus keeps its last reading with a growing age
+        """
+        snapshot = self.snapshot
+        current = now()
+        return {
+            "sequence": snapshot.sequence,
+            "readings": {name: {"timestamp": reading.timestamp, "age": current - reading.timestamp}
+                         for name, reading in snapshot.readings.items()},
+            "errors": dict(snapshot.errors)
+        }
+
+    def _publish(self, readings: Mapping[str, Reading], failed: Optional[str] = None) -> None:
+        old = self.snapshot
+        new_readings = dict(old.readings)
+        new_readings.update(readings)
+        errors = old.errors
+        if failed is not None:
+            errors = dict(errors)
+            errors[failed] = errors.get(failed, 0) + 1
+            errors = MappingProxyType(errors)
+        # single reference assignment, readers see either old or new snapshot
+        self.snapshot = Snapshot(MappingProxyType(new_readings), errors, old.sequence + 1)
+
+    def _sample(self, device: _Device) -> Optional[Pending]:
+        try:
+            values = device.read()
+        except Exception:
+            self._publish({}, device.name)
+            return None
+        if values is None:
+            # keeps the previous reading and its timestamp
+            return None
+        if isinstance(values, Pending):
+            return values
+
+        timestamp = now()
+        if device.group:
+            # groups may return own readings to keep the time of the actual measurement
+            self._publish({name: v if isinstance(v, Reading) else Reading(tuple(v), timestamp)
+                           for name, v in values.items()})
+        else:
+            self._publish({device.name: Reading(tuple(values), timestamp)})
+
+    def _run(self) -> None:
+        start = now()
+        queue = [(start, name) for name in self.devices]
+        heapq.heapify(queue)
+
+        while queue and not self._stop.is_set():
+            due, name = queue[0]
+            delay = due - now()
+            if delay > 0:
+                if self._stop.wait(delay):
+                    break
+                continue
+
+            device = self.devices[name]
+            if device.cycle is None:
+                device.cycle = due
+            pending = self._sample(device)
+            if pending is not None:
+                heapq.heapreplace(queue, (pending.due, name))
+                continue
+
+            # keep the cadence, but skip missed slots instead of bursting
+            next_due = device.cycle + device.period
+            device.cycle = None
+            current = now()
+            if next_due < current:
+                next_due = current + device.period
+            heapq.heapreplace(queue, (next_due, name))
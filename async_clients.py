@@ -0,0 +1,77 @@
+import asyncio
+
+from typing import Any, AsyncIterator, Callable, Optional
+
+from starlette.requests import Request
+
+
+class ClientQueue:
+    """
+    bounded queue of one asyncio client, fed from the event loop
+
+    when the client falls behind its oldest item is dropped, so it skips
+    items instead of slowing the others down, None ends the client
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    @property
+    def maxsize(self) -> int:
+        return self._queue.maxsize
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def full(self) -> bool:
+        return self._queue.full()
+
+    def put(self, item: Any) -> bool:
+        """
+        never blocks
+
+        returns:
+            True when the oldest item was dropped for it
+        """
+        dropped = self._queue.full()
+        if dropped:
+            self._queue.get_nowait()
+        self._queue.put_nowait(item)
+        return dropped
+
+    def close(self) -> None:
+        # ends the client right away, even when nothing else comes
+        self.put(None)
+
+    async def get(self, timeout: Optional[float] = None) -> Any:
+        """
+        raises:
+            asyncio.TimeoutError when nothing comes within timeout
+        """
+        if timeout is None:
+            return await self._queue.get()
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                break
+            yield item
+
+
+def watch_disconnect(request: Request, on_disconnect: Callable[[], None]) -> asyncio.Future:
+    """
+    calls on_disconnect as soon as the client disconnects, a streaming
+    response only notices it with the next item it sends
+
+    returns:
+        watcher task, cancel it when the client is done
+    """
+    async def watch() -> None:
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                break
+        on_disconnect()
+    return asyncio.ensure_future(watch())
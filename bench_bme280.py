@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+"""
+compares speed and agreement of the BME280 float and integer compensation
+
+usage:
+    python bench_bme280.py [samples] [--bus N]
+
+without --bus the datasheet example calibration is used
+"""
+
+import struct
+import time
+from sys import argv
+
+import numpy as np
+from smbus2 import SMBus
+
+from bme280 import BME280, BME280_CHIP_ID, compensate_batch
+from my_i2c import I2C_M_RD
+
+
+class _DatasheetBus:
+    # replays the calibration of the datasheet example (chapter 8.1) instead of a real sensor
+
+    def __init__(self) -> None:
+        self.registers = [0] * 256
+        self.registers[BME280.BME280_REGISTER_CHIP_ID] = BME280_CHIP_ID
+        cal1 = struct.pack("<HhhHhhhhhhhh", 27504, 26435, -1000,
+                           36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000)
+        self.registers[0x88:0x88 + 24] = cal1
+        self.registers[BME280.BME280_REGISTER_DIG_H1] = 75
+        # H2 = 362, H3 = 0, H4 = 313, H5 = 50, H6 = 30
+        self.registers[0xE1:0xE8] = struct.pack("<hB", 362, 0) + bytes([313 >> 4, (313 & 0x0F) | ((50 & 0x0F) << 4),
+                                                                         50 >> 4, 30])
+
+    def read_i2c_block_data(self, address: int, register: int, length: int) -> list:
+        return list(self.registers[register:register + length])
+
+    def write_byte_data(self, address: int, register: int, value: int) -> None:
+        pass
+
+    def i2c_rdwr(self, *messages) -> None:
+        register = 0
+        for message in messages:
+            if message.flags & I2C_M_RD:
+                for i in range(message.len):
+                    message.buf[i] = bytes([self.registers[register + i]])
+            else:
+                register = message.buf[0][0]
+
+
+def _time_scalar(sensor: BME280, raw: np.ndarray, integer: bool) -> tuple:
+    # compensate() follows the mode of the sensor, restore it afterwards
+    mode = sensor.integer
+    sensor.integer = integer
+    rows = raw.tolist()
+    try:
+        start = time.perf_counter()
+        results = [sensor.compensate(*row) for row in rows]
+        return time.perf_counter() - start, np.array(results)
+    finally:
+        sensor.integer = mode
+
+
+def _time_batch(sensor: BME280, raw: np.ndarray, integer: bool) -> float:
+    calibration = sensor.coefficients()
+    start = time.perf_counter()
+    compensate_batch(raw, calibration, integer=integer)
+    return time.perf_counter() - start
+
+
+def main():
+    samples = 100000
+    bus = None
+    args = argv[1:]
+    if "--bus" in args:
+        index = args.index("--bus")
+        bus = SMBus(int(args[index + 1]))
+        del args[index:index + 2]
+    if args:
+        samples = int(args[0])
+
+    sensor = BME280(bus if bus is not None else _DatasheetBus())
+
+    # raw words of roughly -40..85 C, 300..1100 hPa and 0..100 %RH
+    rng = np.random.default_rng(0)
+    raw = np.stack([rng.integers(250000, 600000, samples),
+                    rng.integers(400000, 600000, samples),
+                    rng.integers(20000, 45000, samples)], axis=1)
+
+    float_time, float_results = _time_scalar(sensor, raw, integer=False)
+    integer_time, integer_results = _time_scalar(sensor, raw, integer=True)
+    float_batch = _time_batch(sensor, raw, integer=False)
+    integer_batch = _time_batch(sensor, raw, integer=True)
+
+    print(f"Samples              : {samples}")
+    print(f"Scalar float         : {float_time / samples * 1e6:.2f} us/sample")
+    print(f"Scalar integer       : {integer_time / samples * 1e6:.2f} us/sample")
+    print(f"Batch float          : {float_batch / samples * 1e9:.1f} ns/sample")
+    print(f"Batch integer        : {integer_batch / samples * 1e9:.1f} ns/sample")
+
+    difference = np.abs(float_results - integer_results).max(axis=0)
+    print(f"Max |T float - int|  : {difference[0]:.4f} C")
+    print(f"Max |P float - int|  : {difference[1]:.4f} hPa")
+    print(f"Max |H float - int|  : {difference[2]:.4f} %")
+
+    if bus is not None:
+        bus.close()
+    else:
+        # datasheet example: adc_T = 519888, adc_P = 415148 -> 25.08 C, 1006.53 hPa
+        sensor.integer = False
+        print(f"Datasheet example    : float {sensor.compensate(415148, 519888, 0)[:2]}")
+        sensor.integer = True
+        print(f"                       integer {sensor.compensate(415148, 519888, 0)[:2]}")
+
+
+if __name__ == "__main__":
+    main()
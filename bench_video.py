@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+"""
+measures steady state allocations and time of the video pipeline per frame
+
+usage:
+    python bench_video.py [frames] [--width W] [--height H]
+
+synthetic frames are processed by CameraPipeline.process() without a camera,
+once unchanged (change detection only) and once changing (resize, overlay
+and encoding of every rendition)
+
+allocated memory is the sum of all allocations made while processing a
+frame, buffers freed again before the frame is done included: every C call
+made from Python is traced on its own and adds the peak of traced memory
+above the one at its start
+
+retained memory of changing frames is the latest chunk of every rendition,
+held by its broadcaster, it stays the same for any number of frames
+
+exits with status 1 when a frame buffer is allocated per frame: unchanged
+frames must stay below UNCHANGED_LIMIT bytes, changing ones below the
+encoded output (ENCODER_COPIES of every chunk) plus UNCHANGED_LIMIT, and
+the frame pools must not grow after the warm-up
+"""
+
+import sys
+import time
+import tracemalloc
+from sys import argv, exit
+
+import numpy as np
+
+from video_stream import CameraPipeline
+
+
+RENDITIONS = {"thumbnail": (160, 60), "standard": (400, 80), "full": (0, 90)}
+WARMUP = 20
+# bytes allocated per unchanged frame, the change detector works in preallocated buffers
+UNCHANGED_LIMIT = 16 * 1024
+# allocations of every encoded frame: the JPEG of the encoder and the multipart chunk
+ENCODER_COPIES = 2
+
+
+class _AllocationCounter:
+    # profile function summing the allocations of every C call
+
+    def __init__(self) -> None:
+        self.total = 0
+        self._starts: list = []
+
+    def __call__(self, frame, event: str, arg) -> None:
+        if event == "c_call":
+            tracemalloc.reset_peak()
+            self._starts.append(tracemalloc.get_traced_memory()[0])
+        elif event in ("c_return", "c_exception") and self._starts:
+            self.total += max(0, tracemalloc.get_traced_memory()[1] - self._starts.pop())
+            # an outer call goes on from here
+            tracemalloc.reset_peak()
+
+
+def _measure(pipeline: CameraPipeline, frames: list, count: int) -> tuple:
+    """
+    returns:
+        (mean time in ms, mean bytes allocated per frame, bytes retained after all frames,
+        frame pool allocations after the warm-up, mean size of the encoded chunks per frame),
+        time and chunk sizes are taken in a separate run without tracing
+    """
+    for i in range(WARMUP):
+        pipeline.process(frames[i % len(frames)])
+    allocations = _allocations(pipeline)
+
+    elapsed = 0.0
+    encoded = 0
+    for i in range(count):
+        sequences = [broadcaster.sequence for broadcaster in pipeline.renditions.values()]
+        started = time.perf_counter()
+        pipeline.process(frames[i % len(frames)])
+        elapsed += time.perf_counter() - started
+        encoded += sum(len(broadcaster.chunk) for broadcaster, sequence in zip(pipeline.renditions.values(), sequences)
+                       if broadcaster.sequence != sequence)
+
+    counter = _AllocationCounter()
+    tracemalloc.start()
+    start_current, _ = tracemalloc.get_traced_memory()
+    sys.setprofile(counter)
+    try:
+        for i in range(count):
+            pipeline.process(frames[i % len(frames)])
+    finally:
+        sys.setprofile(None)
+    end_current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (elapsed / count * 1000, counter.total / count, end_current - start_current,
+            _allocations(pipeline) - allocations, encoded / count)
+
+
+def _allocations(pipeline: CameraPipeline) -> int:
+    return sum(pool.allocations for pool in pipeline.pools.values())
+
+
+def _print(title: str, result: tuple) -> None:
+    elapsed, allocated, retained = result[:3]
+    print(f"{title:<22}: {elapsed:7.2f} ms  {allocated / 1024:9.1f} KiB allocated  {retained / 1024:8.1f} KiB retained")
+
+
+def main() -> None:
+    count = 200
+    width, height = 640, 480
+    args = argv[1:]
+    if "--width" in args:
+        width = int(args.pop(args.index("--width") + 1))
+        args.remove("--width")
+    if "--height" in args:
+        height = int(args.pop(args.index("--height") + 1))
+        args.remove("--height")
+    if args:
+        count = int(args[0])
+
+    random = np.random.RandomState(0)
+    base = random.randint(0, 255, (height, width, 3)).astype(np.uint8)
+    moved = base.copy()
+    moved[height // 3:height // 2, width // 3:width // 2] = 255
+
+    pipeline = CameraPipeline("bench", renditions=RENDITIONS, change_threshold=8, keepalive=1e9)
+    for broadcaster in pipeline.renditions.values():
+        broadcaster.subscribe()
+
+    print(f"Frames                : {count} of {width}x{height}")
+    unchanged = _measure(pipeline, [base], count)
+    _print("Unchanged", unchanged)
+    changing = _measure(pipeline, [base, moved], count)
+    _print("Changing, 3 renditions", changing)
+    encoded = changing[4]
+    print(f"Encoded chunks        : {encoded / 1024:.1f} KiB per frame, allocated by the encoder")
+    print(f"Pool allocations      : {_allocations(pipeline)}")
+
+    failures = []
+    if unchanged[1] > UNCHANGED_LIMIT:
+        failures.append(f"unchanged frames allocate {unchanged[1] / 1024:.1f} KiB, limit {UNCHANGED_LIMIT / 1024:.1f} KiB")
+    changing_limit = ENCODER_COPIES * encoded + UNCHANGED_LIMIT
+    if changing[1] > changing_limit:
+        failures.append(f"changing frames allocate {changing[1] / 1024:.1f} KiB, "
+                        f"limit {changing_limit / 1024:.1f} KiB for the encoded output")
+    if unchanged[3] or changing[3]:
+        failures.append(f"frame pools grew by {unchanged[3] + changing[3]} buffers after the warm-up")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if failures:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,17 @@
 #!/usr/bin/python
 
 import time
+from typing import Optional, Union
+
+import numpy as np
 from smbus2 import SMBus
 
 from my_utils import *
+from calibration_cache import CalibrationCache
+from my_i2c import I2CTransaction
 
 BME280_ADDRESS = 0x76  # Default device I2C address
+BME280_CHIP_ID = 0x60
 
 
 class BME280:
@@ -59,18 +65,66 @@ class BME280:
         4: 2  # normal
     }
 
-    def __init__(self, bus: SMBus):
+    # standby time in ms between normal mode measurements
+    standby = {
+        0.5: 0,
+        62.5: 1,
+        125: 2,
+        250: 3,
+        500: 4,
+        1000: 5,
+        10: 6,
+        20: 7
+    }
+
+    iir_filter = {
+        0: 0,  # off
+        2: 1,
+        4: 2,
+        8: 3,
+        16: 4
+    }
+
+    STATUS_MEASURING = 0x08
+    # the sensor timer is not exact, a measurement is only taken as new by
+    # its timing once the expected time plus this share has passed
+    TIME_TOLERANCE = 0.25
+    # burst read of status and data registers, 15 bytes at 100 kHz
+    STREAM_READ_TIME = 0.0015
+
+    def __init__(self, bus: SMBus, cache: Optional[CalibrationCache] = None, integer: bool = False):
+        """
+        :param integer: use the Bosch 32/64-bit integer compensation
+            instead of the double precision one
+        """
         self.bus: SMBus = bus
+        self.integer = integer
 
         try:
             self.chip_id, self.chip_version = self.id()
         except Exception:
             raise Exception("No BME280 sensor on bus")
 
-        # Read blocks of calibration data from EEPROM
-        cal1 = bus.read_i2c_block_data(BME280_ADDRESS, self.BME280_REGISTER_DIG_T1, 24)
-        cal2 = bus.read_i2c_block_data(BME280_ADDRESS, self.BME280_REGISTER_DIG_H1, 1)
-        cal3 = bus.read_i2c_block_data(BME280_ADDRESS, self.BME280_REGISTER_DIG_H2, 7)
+        # Read blocks of calibration data from EEPROM or from cache
+        bus_id = getattr(bus, "bus", None)
+        use_cache = cache is not None and bus_id is not None and self.chip_id == BME280_CHIP_ID
+        calibration = None
+        if use_cache:
+            calibration = cache.get(bus_id, BME280_ADDRESS, self.chip_id)
+            if calibration is not None and len(calibration) != 33:
+                calibration = None
+        if calibration is None:
+            # 0x88 - 0xA1 (T, P and H1) and 0xE1 - 0xE7 (H2 - H6) in one transaction
+            transaction = I2CTransaction()
+            transaction.write_read(BME280_ADDRESS, self.BME280_REGISTER_DIG_T1, 26)
+            transaction.write_read(BME280_ADDRESS, self.BME280_REGISTER_DIG_H2, 7)
+            calibration = transaction.execute(bus).tolist()
+            if use_cache:
+                cache.put(bus_id, BME280_ADDRESS, self.chip_id, calibration)
+
+        cal1 = calibration[0:24]
+        cal2 = calibration[25:26]
+        cal3 = calibration[26:33]
 
         # Convert byte data to word values
         self.dig_T1 = get_ushort_le(cal1, 0)
@@ -105,6 +159,26 @@ class BME280:
         self.set_temperature_oversampling(2)
         self.set_control_mode(2)
 
+        # forced mode split-phase conversion, None when the last collect
+        # in normal mode had no new measurement
+        self.ready_at: Optional[float] = 0.0
+        self._converting = False
+
+        # normal mode streaming
+        self.streaming = False
+        self.output_period = 0.0
+        self.next_sample_at = 0.0
+        # time the latest returned measurement was found to be done
+        self._sample_at = 0.0
+        # first time a measurement was seen running since then
+        self._measuring_at: Optional[float] = None
+
+        # data reads, each one is a single i2c_rdwr call
+        self._data_read = I2CTransaction()
+        self._data_read.write_read(BME280_ADDRESS, self.BME280_REGISTER_PRESSURE_DATA, 8)
+        self._stream_read = I2CTransaction()
+        self._stream_read.write_read(BME280_ADDRESS, self.BME280_REGISTER_STATUS, 12)
+
     def id(self):
         # Chip ID Register Address
         chip_id, chip_version = self.bus.read_i2c_block_data(BME280_ADDRESS, self.BME280_REGISTER_CHIP_ID, 2)
@@ -161,15 +235,156 @@ class BME280:
                                  self.BME280_REGISTER_CONTROL,
                                  temp)
 
-    def read_all(self):
-        self.set_control_mode(2)
-        time.sleep(self.wait_time / 1000)
-
-        # Read temperature/pressure/humidity
-        data = self.bus.read_i2c_block_data(BME280_ADDRESS, self.BME280_REGISTER_PRESSURE_DATA, 8)
+    def start_normal_mode(self, standby: float = 0.5, iir_filter: int = 0):
+        """
+        configures oversampling, standby time and IIR filter once and lets
+        the sensor measure continuously, after that every read is a single
+        burst read of the data registers
+
+        :param standby: standby time in ms between measurements
+        :param iir_filter: IIR filter coefficient
+        """
+        if standby not in self.standby:
+            raise ValueError(f"Unsupported BME280 standby time: {standby}")
+        if iir_filter not in self.iir_filter:
+            raise ValueError(f"Unsupported BME280 IIR filter coefficient: {iir_filter}")
+
+        # config register writes are ignored in normal mode, so go to sleep first
+        self.bus.write_byte_data(BME280_ADDRESS, self.BME280_REGISTER_CONTROL, 0)
+        self.bus.write_byte_data(BME280_ADDRESS,
+                                 self.BME280_REGISTER_CONTROL_HUMID,
+                                 self.oversampling[self.oversampling_hum])
+        self.bus.write_byte_data(BME280_ADDRESS,
+                                 self.BME280_REGISTER_CONFIG,
+                                 (self.standby[standby] << 5) | (self.iir_filter[iir_filter] << 2))
+        # ctrl_meas is written last, humidity settings only apply after it
+        self.bus.write_byte_data(BME280_ADDRESS,
+                                 self.BME280_REGISTER_CONTROL,
+                                 (self.oversampling[self.oversampling_temp] << 5) |
+                                 (self.oversampling[self.oversampling_pres] << 2) |
+                                 0x03)
+
+        self.streaming = True
+        self.output_period = (self.wait_time + standby) / 1000
+        self.next_sample_at = time.monotonic() + self.wait_time / 1000
+        # the first measurement is running, so it is new whenever it is done
+        self._sample_at = float("-inf")
+        self._measuring_at = None
+
+    def read_stream(self) -> Optional[tuple]:
+        """
+        freshness comes from the measuring status bit and the timing, not from
+        the data, two measurements may well be equal: a measurement is new when
+        one was seen running since the previous one and it is done now, or when
+        the sensor is idle longer after the previous one than the standby takes
+
+        returns:
+            None if the sensor has not produced a new measurement yet
+            (temperature, pressure, humidity) of a new measurement
+        """
+        if not self.streaming:
+            return self.read_all()
+        now = time.monotonic()
+        if now < self.next_sample_at:
+            return None
+
+        # status, ctrl_meas, config, reserved and 8 data bytes in one transaction
+        data = self._stream_read.execute(self.bus)
+        measuring = data[0] & self.STATUS_MEASURING
+        # longest measurement and standby time
+        measurement_time = self.wait_time / 1000 * (1 + self.TIME_TOLERANCE)
+        standby = self.output_period - self.wait_time / 1000
+        idle_time = standby * (1 + self.TIME_TOLERANCE)
+        if measuring:
+            # the data registers hold the previous measurement until the running one is done
+            if self._measuring_at is None:
+                self._measuring_at = now
+            if (now - self._measuring_at < measurement_time
+                    and now - self._sample_at < idle_time + measurement_time):
+                self.next_sample_at = self._measuring_at + measurement_time
+                return None
+        elif self._measuring_at is None and now - self._sample_at < idle_time:
+            # may still be the standby after the returned measurement
+            self.next_sample_at = min(now + measurement_time / 2, self._sample_at + idle_time)
+            return None
+
+        self._sample_at = now
+        if measuring:
+            # the running measurement is the next new one
+            self._measuring_at = now
+            self.next_sample_at = now + measurement_time
+        else:
+            # the next measurement starts after this one and the standby time,
+            # look a bit earlier and go on while the sensor is idle
+            self.next_sample_at = (now if self._measuring_at is None else self._measuring_at) + \
+                standby / (1 + self.TIME_TOLERANCE)
+            self._measuring_at = None
+        return self.compensate(*self.decode(data[4:12]))
+
+    def start_conversion(self) -> float:
+        """
+        triggers a forced mode measurement, in normal mode the sensor
+        measures on its own and can be collected right away
+
+        returns:
+            time.monotonic() value when the result can be collected
+        """
+        if self.streaming:
+            self.ready_at = time.monotonic()
+        else:
+            self.set_control_mode(2)
+            self.ready_at = time.monotonic() + self.wait_time / 1000
+        self._converting = True
+        return self.ready_at
+
+    def collect(self) -> Optional[tuple]:
+        """
+        returns:
+            None if the measurement is not finished yet, in normal mode
+                None with ready_at None if there is no new measurement
+            (temperature, pressure, humidity) otherwise
+        """
+        if not self._converting:
+            self.start_conversion()
+        if time.monotonic() < self.ready_at:
+            return None
+        if self.streaming:
+            # the same measurement is never reported twice, without a new
+            # one the device is skipped instead of holding the cycle up
+            self._converting = False
+            result = self.read_stream()
+            if result is None:
+                self.ready_at = None
+            return result
+        self._converting = False
+        data = self._data_read.execute(self.bus)
+        return self.compensate(*self.decode(data))
+
+    def sample_time(self) -> float:
+        # time of one sample in seconds, in normal mode just the burst read
+        if self.streaming:
+            return self.STREAM_READ_TIME
+        return self.wait_time / 1000
+
+    def decode(self, data: Union[list, tuple]) -> tuple:
+        # returns raw pressure, temperature and humidity words of 8 data bytes
         pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
         temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
         hum_raw = (data[6] << 8) | data[7]
+        return pres_raw, temp_raw, hum_raw
+
+    def read_all(self):
+        if not self.streaming:
+            self.set_control_mode(2)
+            time.sleep(self.wait_time / 1000)
+
+        # Read temperature/pressure/humidity
+        data = self._data_read.execute(self.bus)
+        return self.compensate(*self.decode(data))
+
+    def compensate(self, pres_raw: int, temp_raw: int, hum_raw: int) -> tuple:
+        if self.integer:
+            return self.compensate_integer(pres_raw, temp_raw, hum_raw)
 
         # Refine temperature
         var1 = (((temp_raw >> 3) - (self.dig_T1 << 1)) * self.dig_T2) >> 11
@@ -183,7 +398,7 @@ class BME280:
         var2 = var1 * var1 * self.dig_p[4] / 32768.0
         var2 = var2 + var1 * self.dig_p[3] * 2.0
         var2 = var2 / 4.0 + self.dig_p[2] * 65536.0
-        var1 = (self.dig_p[2] * var1 * var1 / 524288.0 + self.dig_p[0] * var1) / 524288.0
+        var1 = (self.dig_p[1] * var1 * var1 / 524288.0 + self.dig_p[0] * var1) / 524288.0
         var1 = (1.0 + var1 / 32768.0) * self.dig_P1
         if var1 == 0:
             pressure = 0
@@ -208,6 +423,161 @@ class BME280:
 
         return temperature / 100.0, pressure / 100.0, humidity
 
+    def compensate_integer(self, pres_raw: int, temp_raw: int, hum_raw: int) -> tuple:
+        # Bosch reference integer compensation (datasheet 4.2.3, BME280_compensate_*_int*)
+        var1 = (((temp_raw >> 3) - (self.dig_T1 << 1)) * self.dig_T2) >> 11
+        var2 = (((((temp_raw >> 4) - self.dig_T1) *
+                  ((temp_raw >> 4) - self.dig_T1)) >> 12) * self.dig_T3) >> 14
+        t_fine = var1 + var2
+        temperature = ((t_fine * 5) + 128) >> 8
+
+        # pressure in Pa as unsigned 32 bit integer in Q24.8 format
+        var1 = t_fine - 128000
+        var2 = var1 * var1 * self.dig_p[4]
+        var2 = var2 + ((var1 * self.dig_p[3]) << 17)
+        var2 = var2 + (self.dig_p[2] << 35)
+        var1 = ((var1 * var1 * self.dig_p[1]) >> 8) + ((var1 * self.dig_p[0]) << 12)
+        var1 = (((1 << 47) + var1) * self.dig_P1) >> 33
+        if var1 == 0:
+            pressure = 0
+        else:
+            pressure = 1048576 - pres_raw
+            pressure = _div_trunc(((pressure << 31) - var2) * 3125, var1)
+            var1 = (self.dig_p[7] * (pressure >> 13) * (pressure >> 13)) >> 25
+            var2 = (self.dig_p[6] * pressure) >> 19
+            pressure = ((pressure + var1 + var2) >> 8) + (self.dig_p[5] << 4)
+
+        # humidity in %RH as unsigned 32 bit integer in Q22.10 format
+        humidity = t_fine - 76800
+        humidity = (((((hum_raw << 14) - (self.dig_H4 << 20) - (self.dig_H5 * humidity)) + 16384) >> 15) *
+                    (((((((humidity * self.dig_H6) >> 10) * (((humidity * self.dig_H3) >> 11) + 32768)) >> 10) +
+                       2097152) * self.dig_H2 + 8192) >> 14))
+        humidity = humidity - (((((humidity >> 15) * (humidity >> 15)) >> 7) * self.dig_H1) >> 4)
+        humidity = min(max(humidity, 0), 419430400)
+        humidity = humidity >> 12
+
+        return temperature / 100.0, pressure / 25600.0, humidity / 1024.0
+
+    def coefficients(self) -> dict:
+        # calibration coefficients for compensate_batch()
+        return {
+            "T1": self.dig_T1, "T2": self.dig_T2, "T3": self.dig_T3,
+            "P1": self.dig_P1, "P": tuple(self.dig_p),
+            "H1": self.dig_H1, "H2": self.dig_H2, "H3": self.dig_H3,
+            "H4": self.dig_H4, "H5": self.dig_H5, "H6": self.dig_H6
+        }
+
+
+def _div_trunc(a, b):
+    # C integer division, rounds toward zero
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+def decode_batch(data: np.ndarray) -> np.ndarray:
+    """
+    :param data: (N, 8) array of data register bytes 0xF7 - 0xFE
+
+    returns:
+        (N, 3) int64 array of raw pressure, temperature and humidity words
+    """
+    data = np.asarray(data, dtype=np.int64)
+    raw = np.empty((data.shape[0], 3), dtype=np.int64)
+    raw[:, 0] = (data[:, 0] << 12) | (data[:, 1] << 4) | (data[:, 2] >> 4)
+    raw[:, 1] = (data[:, 3] << 12) | (data[:, 4] << 4) | (data[:, 5] >> 4)
+    raw[:, 2] = (data[:, 6] << 8) | data[:, 7]
+    return raw
+
+
+def compensate_batch(raw: np.ndarray, calibration: dict, integer: bool = False) -> tuple:
+    """
+    vectorized BME280.compensate(), results are bit-for-bit equal to the scalar path
+
+    :param raw: (N, 3) array of raw pressure, temperature and humidity words
+    :param calibration: BME280.coefficients()
+    :param integer: use the Bosch integer compensation (BME280.compensate_integer())
+
+    returns:
+        (temperature, pressure, humidity) float64 arrays in C, hPa and %
+    """
+    raw = np.asarray(raw, dtype=np.int64)
+    pres_raw, temp_raw, hum_raw = raw[:, 0], raw[:, 1], raw[:, 2]
+    T1, T2, T3 = calibration["T1"], calibration["T2"], calibration["T3"]
+    P1, P = calibration["P1"], calibration["P"]
+    H1, H2, H3 = calibration["H1"], calibration["H2"], calibration["H3"]
+    H4, H5, H6 = calibration["H4"], calibration["H5"], calibration["H6"]
+
+    # Refine temperature, int64 shifts floor like python ints
+    var1 = (((temp_raw >> 3) - (T1 << 1)) * T2) >> 11
+    var2 = (((((temp_raw >> 4) - T1) * ((temp_raw >> 4) - T1)) >> 12) * T3) >> 14
+    t_fine = var1 + var2
+
+    if integer:
+        return _compensate_batch_integer(pres_raw, hum_raw, t_fine, calibration)
+
+    temperature = (((t_fine * 5) + 128) >> 8).astype(np.float64)
+
+    # Refine pressure and adjust for temperature
+    var1 = t_fine / 2.0 - 64000.0
+    var2 = var1 * var1 * P[4] / 32768.0
+    var2 = var2 + var1 * P[3] * 2.0
+    var2 = var2 / 4.0 + P[2] * 65536.0
+    var1 = (P[1] * var1 * var1 / 524288.0 + P[0] * var1) / 524288.0
+    var1 = (1.0 + var1 / 32768.0) * P1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pressure = 1048576.0 - pres_raw
+        pressure = ((pressure - var2 / 4096.0) * 6250.0) / var1
+        var1_p = P[7] * pressure * pressure / 2147483648.0
+        var2_p = pressure * P[6] / 32768.0
+        pressure = pressure + (var1_p + var2_p + P[5]) / 16.0
+    pressure = np.where(var1 == 0, 0.0, pressure)
+
+    # Refine humidity
+    humidity = t_fine - 76800.0
+    humidity = (hum_raw - (H4 * 64.0 + H5 / 16384.0 * humidity)) * \
+        (H2 / 65536.0 * (1.0 + H6 / 67108864.0 * humidity * (1.0 + H3 / 67108864.0 * humidity)))
+    humidity = humidity * (1.0 - H1 * humidity / 524288.0)
+    humidity = np.clip(humidity, 0, 100)
+
+    return temperature / 100.0, pressure / 100.0, humidity
+
+
+def _compensate_batch_integer(pres_raw: np.ndarray, hum_raw: np.ndarray, t_fine: np.ndarray,
+                              calibration: dict) -> tuple:
+    # vectorized BME280.compensate_integer(), everything fits int64 like in the reference code
+    P1, P = calibration["P1"], calibration["P"]
+    H1, H2, H3 = calibration["H1"], calibration["H2"], calibration["H3"]
+    H4, H5, H6 = calibration["H4"], calibration["H5"], calibration["H6"]
+
+    temperature = ((t_fine * 5) + 128) >> 8
+
+    var1 = t_fine - 128000
+    var2 = var1 * var1 * P[4]
+    var2 = var2 + ((var1 * P[3]) << 17)
+    var2 = var2 + (P[2] << 35)
+    var1 = ((var1 * var1 * P[1]) >> 8) + ((var1 * P[0]) << 12)
+    var1 = (((1 << 47) + var1) * P1) >> 33
+    zero = var1 == 0
+    divisor = np.where(zero, 1, var1)
+    pressure = 1048576 - pres_raw
+    numerator = ((pressure << 31) - var2) * 3125
+    # C division truncates toward zero, numpy floors
+    pressure = np.abs(numerator) // np.abs(divisor)
+    pressure = np.where((numerator < 0) != (divisor < 0), -pressure, pressure)
+    var1 = (P[7] * (pressure >> 13) * (pressure >> 13)) >> 25
+    var2 = (P[6] * pressure) >> 19
+    pressure = ((pressure + var1 + var2) >> 8) + (P[5] << 4)
+    pressure = np.where(zero, 0, pressure)
+
+    humidity = t_fine - 76800
+    humidity = (((((hum_raw << 14) - (H4 << 20) - (H5 * humidity)) + 16384) >> 15) *
+                (((((((humidity * H6) >> 10) * (((humidity * H3) >> 11) + 32768)) >> 10) +
+                   2097152) * H2 + 8192) >> 14))
+    humidity = humidity - (((((humidity >> 15) * (humidity >> 15)) >> 7) * H1) >> 4)
+    humidity = np.clip(humidity, 0, 419430400) >> 12
+
+    return temperature / 100.0, pressure / 25600.0, humidity / 1024.0
+
 
 def main():
     bus = SMBus(1)  # Rev 2 Pi, Pi 2 & Pi 3 uses bus 1
@@ -0,0 +1,132 @@
+import time
+
+from collections import deque
+from typing import Any, Callable, Dict, Optional, Union
+
+from acquisition import Pending
+from bus_worker import BusWorker
+
+
+class BusScheduler:
+    """
+    interleaves conversions of devices sharing one bus
+
+    every driver has to provide split-phase conversion API:
+        start_conversion() -> time when the result can be collected
+        collect() -> None until the sample is complete, values otherwise,
+            None with ready_at None when the device has no new sample this
+            cycle (e.g. a BME280 measuring on its own), it is skipped then
+        ready_at -> time when the running conversion is done
+        sample_time() -> bus or conversion time of one sample
+
+    all conversions are started at once and the device which is ready first
+    is served first, so one cycle takes about as long as the slowest device
+    instead of the sum of all of them
+
+    step() never waits, it returns the time of its next step instead, so the
+    acquisition engine samples other devices while conversions are running
+    """
+
+    # number of latest cycles kept for statistics
+    HISTORY = 100
+
+    def __init__(self, worker: Optional[BusWorker] = None) -> None:
+        """
+        :param worker: owner of the bus, every transaction is executed there
+            while waiting for conversions leaves the bus free for others
+        """
+        self.devices: Dict[str, Any] = {}
+        self.worker = worker
+        self.cycles = 0
+        # collects done while another device of the cycle was converting
+        self.overlapped = 0
+        # devices without a new sample in their cycle
+        self.skipped = 0
+        self._cycle_times: deque = deque(maxlen=self.HISTORY)
+        self._pending: Dict[str, float] = {}
+        self._results: Dict[str, tuple] = {}
+        self._cycle_start = 0.0
+
+    def add_device(self, name: str, driver: Any) -> None:
+        self.devices[name] = driver
+
+    def _bus(self, fn: Callable) -> Any:
+        if self.worker is None:
+            return fn()
+        return self.worker.call(fn)
+
+    def step(self) -> Union[Dict[str, tuple], Pending]:
+        """
+        starts a cycle or collects the devices which are ready
+
+        returns:
+            {device name: values} of the devices with a new sample when the cycle
+            is complete, Pending with the time of the next step otherwise
+        """
+        try:
+            return self._step()
+        except Exception:
+            # a failed device restarts the whole cycle on the next step
+            self._pending.clear()
+            raise
+
+    def _step(self) -> Union[Dict[str, tuple], Pending]:
+        if not self._pending:
+            self._cycle_start = time.monotonic()
+            self._results = {}
+            for name, driver in self.devices.items():
+                self._pending[name] = self._bus(driver.start_conversion)
+
+        while self._pending:
+            name = min(self._pending, key=self._pending.get)
+            if self._pending[name] > time.monotonic():
+                return Pending(self._pending[name])
+
+            driver = self.devices[name]
+            result = self._bus(driver.collect)
+            if len(self._pending) > 1:
+                self.overlapped += 1
+            if result is not None:
+                self._results[name] = result
+                del self._pending[name]
+            elif driver.ready_at is None:
+                self.skipped += 1
+                del self._pending[name]
+            else:
+                # next phase of the sample (e.g. MS5611 D1 after D2) was started
+                self._pending[name] = driver.ready_at
+
+        self.cycles += 1
+        self._cycle_times.append(time.monotonic() - self._cycle_start)
+        return self._results
+
+    def read_all(self) -> Dict[str, tuple]:
+        """
+        blocking version of step() for callers without the acquisition engine
+
+        returns:
+            {device name: values} of one cycle
+        """
+        while True:
+            result = self.step()
+            if not isinstance(result, Pending):
+                return result
+            time.sleep(max(0.0, result.due - time.monotonic()))
+
+    def stats(self) -> dict:
+        """
+        returns:
+            achieved cycle time against the theoretical one (slowest device)
+            and the one of sequential reading (sum of all devices), all in ms,
+            and how many collects were done while another device was converting
+        """
+        sample_times = [driver.sample_time() for driver in self.devices.values()]
+        cycle_times = list(self._cycle_times)
+        return {
+            "cycles": self.cycles,
+            "overlapped": self.overlapped,
+            "skipped": self.skipped,
+            "achieved": sum(cycle_times) / len(cycle_times) * 1000 if cycle_times else None,
+            "theoretical": max(sample_times, default=0.0) * 1000,
+            "sequential": sum(sample_times) * 1000
+        }
@@ -0,0 +1,54 @@
+import json
+
+from os import replace
+from os.path import exists
+from threading import Lock
+from typing import Optional, Union
+
+
+class CalibrationCache:
+    """
+    on-disk cache of sensor calibration coefficients
+
+    entries are keyed by bus, address and a device specific check value
+    (chip ID for BME280, PROM CRC word for MS5611), an entry with another
+    check value is treated as missing
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = Lock()
+        self._entries: dict = {}
+        if exists(path):
+            try:
+                with open(path) as handle:
+                    self._entries = json.load(handle)
+            except (OSError, ValueError):
+                # broken cache file is rebuilt from scratch
+                self._entries = {}
+
+    @staticmethod
+    def _name(bus: Union[None, int, str], address: int) -> str:
+        return f"{bus}:{address:#04x}"
+
+    def get(self, bus: Union[None, int, str], address: int, check: int) -> Optional[list]:
+        with self._lock:
+            entry = self._entries.get(self._name(bus, address))
+        if entry is None or entry.get("check") != check:
+            return None
+        return list(entry["data"])
+
+    def put(self, bus: Union[None, int, str], address: int, check: int, data: list) -> None:
+        with self._lock:
+            self._entries[self._name(bus, address)] = {"check": check, "data": list(data)}
+            self._save()
+
+    def _save(self) -> None:
+        # write to a temporary file first so a crash never leaves half a cache
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, "w") as handle:
+                json.dump(self._entries, handle, indent=2)
+            replace(temp, self.path)
+        except OSError:
+            pass
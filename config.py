@@ -15,3 +15,120 @@ else:
         if conf.has_option("sensors", name):
             sensors.append(name)
 
+
+# sample rates in Hz for the acquisition engine
+DEFAULT_RATES = {
+    "bme280": 10.0,
+    "ms5611": 20.0,
+    "max6675": 4.0
+}
+
+rates = {}
+for name in DEFAULT_RATES:
+    if conf.has_option("rates", name):
+        rates[name] = conf.getfloat("rates", name)
+    else:
+        rates[name] = DEFAULT_RATES[name]
+
+overlap = conf.getboolean("rates", "overlap", fallback=True)
+
+# MS5611 oversampling, None means planned from the sample rate
+ms5611 = {
+    "osr_pressure": None,
+    "osr_temperature": None,
+    "temperature_interval": 1
+}
+for name in ("osr_pressure", "osr_temperature"):
+    value = conf.get("ms5611", name, fallback="auto")
+    if value != "auto":
+        ms5611[name] = int(value)
+ms5611["temperature_interval"] = conf.getint("ms5611", "temperature_interval", fallback=1)
+
+# BME280 normal mode settings
+bme280 = {
+    "standby": conf.getfloat("bme280", "standby", fallback=62.5),
+    "iir_filter": conf.getint("bme280", "iir_filter", fallback=0),
+    "integer": conf.getboolean("bme280", "integer", fallback=False)
+}
+
+# calibration coefficients cache, None disables it
+calibration_cache = conf.get("calibration", "cache", fallback="calibration.json") or None
+if calibration_cache is not None:
+    calibration_cache = join(dirname(argv[0]), calibration_cache)
+
+# thermocouple name -> chip select
+if conf.has_section("max6675"):
+    max6675 = dict(conf.items("max6675"))
+else:
+    max6675 = {"thermocouple": "CE0"}
+
+# input name -> MyInputs.add_input options
+inputs = {}
+if conf.has_section("inputs"):
+    for name, value in conf.items("inputs"):
+        fields = [field.strip() for field in value.split(",")]
+        options = {"pin": int(fields[0])}
+        if len(fields) > 1:
+            options["edge"] = fields[1]
+        if len(fields) > 2:
+            options["pull"] = fields[2]
+        if len(fields) > 3:
+            options["debounce"] = float(fields[3]) / 1000
+        inputs[name] = options
+
+startup_target = conf.getfloat("startup", "target", fallback=1.0)
+
+video = {
+    "process": conf.getboolean("video", "process", fallback=False),
+    "slots": conf.getint("video", "slots", fallback=8),
+    "slot_size": conf.getint("video", "slot_size", fallback=1 << 20)
+}
+
+# camera name -> CameraPipeline options
+cameras = {}
+for section in conf.sections():
+    if not section.startswith("camera:"):
+        continue
+    source = conf.get(section, "source", fallback="0")
+    options = {
+        "source": source if source == "picamera" else int(source),
+        "width": conf.getint(section, "width", fallback=400),
+        "fps": conf.getfloat(section, "fps", fallback=0),
+        "idle_fps": conf.getfloat(section, "idle_fps", fallback=0),
+        "change_threshold": conf.getfloat(section, "change_threshold", fallback=8),
+        "keepalive": conf.getfloat(section, "keepalive", fallback=1.0),
+        "preload": conf.getboolean(section, "preload", fallback=False),
+        "idle_timeout": conf.getfloat(section, "idle_timeout", fallback=30.0)
+    }
+    renditions = conf.get(section, "renditions", fallback=None)
+    if renditions:
+        # rendition name -> (width, JPEG quality)
+        options["renditions"] = {}
+        for rendition in renditions.split(","):
+            rendition_name, width, quality = rendition.strip().split(":")
+            options["renditions"][rendition_name] = (int(width), int(quality))
+    resolution = conf.get(section, "resolution", fallback=None)
+    if resolution:
+        options["resolution"] = tuple(int(v) for v in resolution.lower().split("x"))
+    cameras[section[len("camera:"):]] = options
+if not cameras:
+    cameras["left"] = {"source": 0, "width": 400, "fps": 0}
+
+# VideoRecorder options, None when recording is disabled
+recording = None
+if conf.getboolean("recording", "enabled", fallback=False):
+    recording = {
+        "directory": join(dirname(argv[0]), conf.get("recording", "directory", fallback="recordings")),
+        "segment_time": conf.getfloat("recording", "segment_time", fallback=300.0),
+        "codec": conf.get("recording", "codec", fallback="mp4v"),
+        "queue_size": conf.getint("recording", "queue_size", fallback=32),
+        "rendition": conf.get("recording", "rendition", fallback="") or None
+    }
+
+# LiveEncoder options, None when live streams are disabled
+live = None
+if conf.getboolean("live", "enabled", fallback=False):
+    live = {
+        "codec": conf.get("live", "codec", fallback="VP80"),
+        "rendition": conf.get("live", "rendition", fallback="") or None
+    }
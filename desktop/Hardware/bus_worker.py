@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from collections import deque
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread, Lock
+from typing import Any, Callable, Optional
+
+
+class BusWorker:
+    """
+    single owner thread of a physical bus
+
+    every transaction is queued and executed in submission order, so drivers
+    sharing a bus never interleave their register sequences
+    """
+
+    # number of latest transactions kept for statistics
+    HISTORY = 1000
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._queue: Queue = Queue()
+        self._stats_lock = Lock()
+        self._wait_times: deque = deque(maxlen=self.HISTORY)
+        self._run_times: deque = deque(maxlen=self.HISTORY)
+        self.transactions = 0
+        self.errors = 0
+        self._thread = Thread(target=self._run, name=f"bus-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        queues fn(*args, **kwargs) for the bus thread
+
+        returns:
+            concurrent.futures.Future with the result of fn
+        """
+        future = Future()
+        self._queue.put((future, fn, args, kwargs, time.perf_counter()))
+        return future
+
+    def call(self, fn: Callable, *args, **kwargs) -> Any:
+        # blocking version of submit()
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        # awaitable version of submit(), never blocks the event loop
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        """
+        returns:
+            queue depth, transaction count and latencies in ms,
+            wait is time spent in the queue, run is time spent on the bus
+        """
+        with self._stats_lock:
+            wait_times = list(self._wait_times)
+            run_times = list(self._run_times)
+        return {
+            "queue_depth": self.queue_depth,
+            "transactions": self.transactions,
+            "errors": self.errors,
+            "wait": latency_summary(wait_times),
+            "run": latency_summary(run_times)
+        }
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, fn, args, kwargs, submitted = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                self.errors += 1
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finished = time.perf_counter()
+
+            with self._stats_lock:
+                self.transactions += 1
+                self._wait_times.append(started - submitted)
+                self._run_times.append(finished - started)
+
+
+def latency_summary(values: list) -> Optional[dict]:
+    # mean, 95th percentile and max in ms of latencies in seconds
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "mean": sum(ordered) / len(ordered) * 1000,
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max": ordered[-1] * 1000
+    }
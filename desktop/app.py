@@ -6,6 +6,7 @@ from GUI.main_window import Ui_MainWindow
 from Hardware import RelayDriver
 from Hardware.bme280 import BME280
 from Hardware.ms5611 import MS5611
+from Hardware.bus_worker import BusWorker
 
 
 class App(Ui_MainWindow, QMainWindow):
@@ -21,6 +22,8 @@ class App(Ui_MainWindow, QMainWindow):
 
         # ------- i2c driver section ------------------------
         self.i2c_bus = SMBus(1)
+        # both sensor threads share the bus, so all access goes through its worker
+        self.i2c_worker = BusWorker("i2c-1")
         self.inside_sensor_driver = MS5611(self.i2c_bus)
         self.outside_sensor_driver = BME280(self.i2c_bus)
         self.inside_thread = QThread()
@@ -49,7 +52,7 @@ class App(Ui_MainWindow, QMainWindow):
 
     def inside_thread_routine(self):
         while True:
-            self.inside_pressure, self.inside_temp = self.inside_sensor_driver.read_all()
+            self.inside_pressure, self.inside_temp = self.i2c_worker.call(self.inside_sensor_driver.read_all)
             self.inside_pressure = round(self.inside_pressure, 3)
             self.data_table.item(0, 1).setText(self.inside_temp)
             self.data_table.item(1, 1).setText(self.inside_pressure)
@@ -57,7 +60,8 @@ class App(Ui_MainWindow, QMainWindow):
 
     def outside_thread_routine(self):
         while True:
-            self.outside_temp, self.outside_pressure, self.outside_humidity = self.outside_sensor_driver.read_all()
+            self.outside_temp, self.outside_pressure, self.outside_humidity = \
+                self.i2c_worker.call(self.outside_sensor_driver.read_all)
             self.outside_pressure = round(self.outside_pressure, 3)
             self.outside_humidity = round(self.outside_humidity, 2)
             self.data_table.item(0, 0).setText(self.outside_temp)
@@ -38,8 +38,33 @@ function updateBME(response){
 };
 
 
+function updateInput(name, level){
+    let cell = document.getElementById("input_" + name);
+    if (cell) {
+        cell.textContent = level ? "high" : "low";
+    }
+};
+
+
+function listenInputs(){
+    // inputs are pushed by the server on every edge, no polling
+    let events = new EventSource('/events');
+    events.addEventListener("states", (event) => {
+        let states = JSON.parse(event.data);
+        for (let name in states) {
+            updateInput(name, states[name]);
+        }
+    });
+    events.addEventListener("input", (event) => {
+        let data = JSON.parse(event.data);
+        updateInput(data['name'], data['level']);
+    });
+};
+
+
 document.addEventListener('DOMContentLoaded', function(){
     setInterval(() => getNewData(), 500); // Milliseconds
+    listenInputs();
 
     let toggle_ln2_btn = document.getElementById("toggle_ln2");
     toggle_ln2_btn.addEventListener("click", toggleLN2);
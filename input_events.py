@@ -0,0 +1,106 @@
+import asyncio
+import json
+
+from collections import deque
+from typing import AsyncIterator, Dict, NamedTuple, Optional, Set
+
+from starlette.requests import Request
+
+from acquisition import now
+from async_clients import ClientQueue, watch_disconnect
+from bus_worker import latency_summary
+
+
+class InputEvent(NamedTuple):
+    name: str
+    level: int
+    # kernel time of the edge, same clock as acquisition.now()
+    timestamp: float
+
+
+class EventHub:
+    """
+    pushes input changes from the GPIO alert thread to asyncio clients
+    as server-sent events
+
+    latency is measured from the kernel timestamp of the edge to the moment
+    the event is handed to the web server for a client
+    """
+
+    # number of latest notifications kept for statistics
+    HISTORY = 1000
+    # comment sent to idle clients, so proxies keep the connection open
+    KEEPALIVE = 15.0
+
+    def __init__(self, queue_size: int = 64) -> None:
+        self.queue_size = queue_size
+        self.states: Dict[str, int] = {}
+        self.events = 0
+        self.dropped = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._clients: Set[ClientQueue] = set()
+        self._latencies: deque = deque(maxlen=self.HISTORY)
+
+    def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        # event loop of the asyncio clients
+        self._loop = loop
+
+    def publish(self, name: str, level: int, timestamp: float) -> None:
+        """
+        thread safe, signature of MyInputs callbacks
+        """
+        self.states[name] = level
+        self.events += 1
+        if self._loop is not None and self._clients:
+            try:
+                self._loop.call_soon_threadsafe(self._dispatch, InputEvent(name, level, timestamp))
+            except RuntimeError:
+                # event loop is already closed
+                self._loop = None
+
+    def _dispatch(self, event: InputEvent) -> None:
+        for client in self._clients:
+            if client.put(event):
+                self.dropped += 1
+
+    def _disconnect(self, client: ClientQueue) -> None:
+        self._clients.discard(client)
+        client.close()
+
+    async def stream(self, request: Request) -> AsyncIterator[str]:
+        """
+        async generator of server-sent events for one client, starting with
+        a "states" event of all inputs followed by an "input" event per change
+        """
+        client = ClientQueue(self.queue_size)
+        self._clients.add(client)
+        watcher = watch_disconnect(request, lambda: self._disconnect(client))
+        try:
+            yield f"event: states\ndata: {json.dumps(self.states)}\n\n"
+            while True:
+                try:
+                    event = await client.get(self.KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    break
+                latency = now() - event.timestamp
+                self._latencies.append(latency)
+                data = {**event._asdict(), "latency": latency * 1000}
+                yield f"event: input\ndata: {json.dumps(data)}\n\n"
+        finally:
+            self._clients.discard(client)
+            watcher.cancel()
+
+    def stats(self) -> dict:
+        """
+        returns:
+            event counts and edge to notification latency in ms
+        """
+        return {
+            "events": self.events,
+            "clients": len(self._clients),
+            "dropped": self.dropped,
+            "latency": latency_summary(list(self._latencies))
+        }
@@ -1,51 +1,126 @@
-import threading
+import time
 
-from fastapi import FastAPI, Request
-from uvicorn import run
-from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+# startup time is measured from here, before the heavy imports below, on the
+# clock of acquisition.now(), so the imports are not at the top of the module
+started = time.monotonic()
 
-from os import environ
-from typing import Dict, Any
+import asyncio  # noqa: E402
 
-from video_stream import make_photo_left, generate_left, vs_left
-from config import sensors
+from fastapi import FastAPI, HTTPException, Request  # noqa: E402
+from uvicorn import run  # noqa: E402
+from fastapi.templating import Jinja2Templates  # noqa: E402
+from fastapi.responses import HTMLResponse, Response, StreamingResponse  # noqa: E402
+from fastapi.staticfiles import StaticFiles  # noqa: E402
+from pydantic import BaseModel  # noqa: E402
+
+from os import environ  # noqa: E402
+from typing import Dict, Any, Optional  # noqa: E402
+
+from video_stream import CameraPool  # noqa: E402
+from config import sensors, rates, overlap, ms5611 as ms5611_config, bme280 as bme280_config, calibration_cache  # noqa: E402
+from config import max6675 as max6675_config, cameras as cameras_config, video as video_config, startup_target  # noqa: E402
+from config import recording, live, inputs as inputs_config  # noqa: E402
+from acquisition import AcquisitionEngine, now  # noqa: E402
+from bus_worker import BusWorker  # noqa: E402
+from bus_scheduler import BusScheduler  # noqa: E402
+from input_events import EventHub  # noqa: E402
 
 
 app = FastAPI()
 app.mount('/js', StaticFiles(directory="gui/js"), name="js")
 templates = Jinja2Templates(directory="gui/html")
+engine = AcquisitionEngine()
+workers: Dict[str, BusWorker] = {}
+scheduler = None
+# changes of GPIO inputs pushed to the web page
+input_events = EventHub()
+# seconds since start, first /update is what the user waits for
+startup: Dict[str, Any] = {"target": startup_target, "ready": None, "first_update": None}
+if video_config["process"]:
+    from video_process import CameraProcess
+    cameras = CameraProcess(cameras_config, video_config["slots"], video_config["slot_size"], recording)
+    # forked before the bus workers, GPIO alerts and the server start their threads
+    cameras.start()
+else:
+    cameras = CameraPool(cameras_config, recording, live)
 
 if not environ.get('no_rpi', False):
-    from spidev import SpiDev
-    
     from my_i2c import MyI2CBus
     from bme280 import BME280
-    from ms5611 import MS5611
-    from my_gpio import MyRelay
-    from max6675 import read_celsius
+    from ms5611 import MS5611, plan_oversampling
+    from my_gpio import MyInputs, MyRelay
+    from max6675 import MAX6675
+    from calibration_cache import CalibrationCache
 
     # I2C config section -------------------------------------
     my_i2c_bus = MyI2CBus(1)
+    i2c_worker = workers["i2c-1"] = BusWorker("i2c-1")
+    cache = CalibrationCache(calibration_cache) if calibration_cache else None
     if "bme280" in sensors:
-        my_i2c_bus["outside"] = BME280(my_i2c_bus)
+        my_i2c_bus["outside"] = BME280(my_i2c_bus, cache=cache, integer=bme280_config["integer"])
+        my_i2c_bus["outside"].start_normal_mode(bme280_config["standby"], bme280_config["iir_filter"])
+    # with overlap both sensors are sampled in one group at the higher rate
+    ms5611_rate = rates["ms5611"]
+    if overlap and "bme280" in sensors:
+        ms5611_rate = max(rates["ms5611"], rates["bme280"])
     if "ms5611" in sensors:
-        my_i2c_bus["inside"] = MS5611(my_i2c_bus)
+        interval = ms5611_config["temperature_interval"]
+        osr_pressure, osr_temperature, (pressure_noise, temperature_noise) = plan_oversampling(
+            ms5611_rate, interval,
+            osr_pressure=ms5611_config["osr_pressure"], osr_temperature=ms5611_config["osr_temperature"]
+        )
+        print(f"MS5611 at {ms5611_rate:g} Hz: OSR {osr_pressure}/{osr_temperature}, "
+              f"noise {pressure_noise} mbar / {temperature_noise} C")
+        my_i2c_bus["inside"] = MS5611(
+            my_i2c_bus,
+            osr_pressure=osr_pressure,
+            osr_temperature=osr_temperature,
+            temperature_interval=interval,
+            cache=cache
+        )
     # --------------------------------------------------------
 
     # SPI config section -------------------------------------
     bus_num = 0  # RPI 4 has only 1 bus_num with number 0
-    device = 0  # max6675 starts transmit on CS = 0
-    spi = SpiDev()
-    spi.open(bus_num, device)
-    spi.max_speed_hz = 300000
-    spi.mode = 0
+    thermocouples = MAX6675(bus_num)
+    for name, chip_select in max6675_config.items():
+        thermocouples.add_channel(name, chip_select)
+    spi_worker = workers["spi-0"] = BusWorker("spi-0")
     # --------------------------------------------------------
 
     # GPIO config section
     my_relays = MyRelay()
+    my_inputs = MyInputs()
+    input_errors = {
+        -1: "its pin is already in use",
+        -2: "its name is already in use",
+        -3: "its pin belongs to a bus"
+    }
+    for name, options in inputs_config.items():
+        result = my_inputs.add_input(name, **options)
+        if result != 0:
+            # a misconfigured input would never report, like a bad thermocouple chip select
+            raise ValueError(f"Can not add input \"{name}\" on pin {options['pin']}: {input_errors[result]}")
+    my_inputs.add_callback(input_events.publish)
+    input_events.states.update(my_inputs.states)
+    # --------------------------------------------------------
+
+    # acquisition section ------------------------------------
+    # the BME280 measures on its own in normal mode, only new measurements are
+    # published, in the overlap group it is skipped in cycles without one
+    if overlap:
+        scheduler = BusScheduler(i2c_worker)
+        for name in ("outside", "inside"):
+            if name in my_i2c_bus.devices:
+                scheduler.add_device(name, my_i2c_bus[name])
+        if scheduler.devices:
+            engine.add_group("i2c", scheduler.step, ms5611_rate)
+    else:
+        if "outside" in my_i2c_bus.devices:
+            engine.add_device("outside", my_i2c_bus["outside"].read_stream, rates["bme280"], i2c_worker)
+        if "inside" in my_i2c_bus.devices:
+            engine.add_device("inside", my_i2c_bus["inside"].read_all, rates["ms5611"], i2c_worker)
+    engine.add_group("max6675", thermocouples.poll, rates["max6675"], spi_worker)
     # --------------------------------------------------------
 
     dummy = False
@@ -55,19 +130,66 @@ else:
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
-    return templates.TemplateResponse("root.html", {"request": request, "ln2_state": my_relays.states["liquid_nitrogen_relay"]})
+    return templates.TemplateResponse("root.html", {"request": request,
+                                                    "ln2_state": my_relays.states["liquid_nitrogen_relay"],
+                                                    "cameras": cameras.names(),
+                                                    "inputs": list(inputs_config)})
 
 
 class UpdateResponse(BaseModel):
     inside: Dict[str, Any]
     outside: Dict[str, Any]
     thermocouple: float
+    thermocouples: Dict[str, Any] = {}
+    errors: Dict[str, int] = {}
 
 
-@app.get("/video_left", response_class=StreamingResponse)
-async def video_left():
+def get_broadcaster(name: str, rendition: Optional[str]):
+    if name not in cameras:
+        raise HTTPException(status_code=404, detail=f"No camera \"{name}\"")
+    try:
+        return cameras[name].rendition(rendition)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No rendition \"{rendition}\" of camera \"{name}\"")
+
+
+@app.get("/video/{name}", response_class=StreamingResponse)
+async def video(name: str, request: Request, rendition: Optional[str] = None):
+    broadcaster = get_broadcaster(name, rendition)
     # return the response generated along with the specific media
-    return StreamingResponse(generate_left(), media_type="multipart/x-mixed-replace;boundary=frame")
+    return StreamingResponse(broadcaster.stream(request),
+                             media_type="multipart/x-mixed-replace;boundary=frame")
+
+
+@app.get("/video/{name}/live.webm", response_class=StreamingResponse)
+async def live_video(name: str, request: Request):
+    if name not in cameras.live:
+        raise HTTPException(status_code=404, detail=f"No live stream of camera \"{name}\"")
+    return StreamingResponse(cameras.live[name].stream(request), media_type="video/webm")
+
+
+@app.get("/video/{name}/snapshot.jpg")
+async def snapshot(name: str, request: Request, rendition: Optional[str] = None, max_age: float = 2.0):
+    """
+    latest frame the stream encoder produced, a new one only when it is older
+    than max_age seconds, unchanged frames are answered with 304
+    """
+    broadcaster = get_broadcaster(name, rendition)
+    sequence, jpeg = await broadcaster.latest(max_age, timeout=5.0)
+    if jpeg is None:
+        raise HTTPException(status_code=503, detail=f"No frame of camera \"{name}\"")
+
+    etag = f'"{broadcaster.epoch}-{sequence}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(jpeg, media_type="image/jpeg", headers=headers)
+
+
+@app.get("/video_left", response_class=StreamingResponse)
+async def video_left(request: Request):
+    return await video("left", request)
 
 
 @app.get("/buttons/toggleLN2")
@@ -76,32 +198,106 @@ async def toggleNL2():
     return {"state": state}
 
 
+@app.get("/stats/buses")
+async def bus_stats():
+    return {name: worker.stats() for name, worker in workers.items()}
+
+
+@app.get("/stats/scheduler")
+async def scheduler_stats():
+    if scheduler is None:
+        return {}
+    return scheduler.stats()
+
+
+@app.get("/stats/acquisition")
+async def acquisition_stats():
+    return engine.stats()
+
+
+@app.get("/stats/video")
+async def video_stats():
+    return cameras.stats()
+
+
+@app.get("/events")
+async def events(request: Request):
+    # input changes as server-sent events instead of polling
+    return StreamingResponse(input_events.stream(request), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/stats/inputs")
+async def input_stats():
+    return input_events.stats()
+
+
+@app.get("/stats/startup")
+async def startup_stats():
+    first_update = startup["first_update"]
+    return {**startup, "within_target": None if first_update is None else first_update <= startup["target"]}
+
+
+@app.on_event("startup")
+async def start_acquisition():
+    engine.start()
+
+
+@app.on_event("startup")
+async def attach_video():
+    cameras.attach(asyncio.get_running_loop())
+    input_events.attach(asyncio.get_running_loop())
+    startup["ready"] = now() - started
+
+
+@app.on_event("shutdown")
+async def stop_acquisition():
+    engine.stop()
+
+
 @app.get("/update", response_model=UpdateResponse)
 async def update():
+    if startup["first_update"] is None:
+        startup["first_update"] = now() - started
+        if startup["first_update"] > startup["target"]:
+            print(f"First /update after {startup['first_update']:.2f} s, target is {startup['target']:.2f} s")
     data = {}
     if not dummy:
-        if "outside" in my_i2c_bus.devices:
-            t, p, h = my_i2c_bus['outside'].read_all()
-        else:
-            t, p, h = [-1] * 3
-        
+        snapshot = engine.snapshot
+        current = now()
+
+        def age(name: str) -> Optional[float]:
+            # seconds since the reading, grows while a sensor fails
+            reading = snapshot.readings.get(name)
+            return None if reading is None else round(current - reading.timestamp, 3)
+
+        t, p, h = snapshot.get("outside", (-1, -1, -1))
         data['outside'] = {
             'temperature': t,
             'pressure': round(p, 2),
-            'humidity': round(h, 2)
+            'humidity': round(h, 2),
+            'age': age("outside")
         }
 
-        if "inside" in my_i2c_bus.devices:
-            p, t = my_i2c_bus['inside'].read_all()
-        else:
-            p, t = [-1] * 2
+        p, t = snapshot.get("inside", (-1, -1))
         data['inside'] = {
             'temperature': round(t, 2),
             'pressure': round(p, 2),
+            'age': age("inside")
         }
 
-        data['thermocouple'] = read_celsius(spi)
-        # data['thermocouple'] = 25.0  # dummy data
+        data['thermocouple'] = snapshot.get("thermocouple", (-1, ))[0]
+        data['thermocouples'] = {}
+        for name in thermocouples.channels:
+            reading = snapshot.readings.get(name)
+            if reading is not None:
+                data['thermocouples'][name] = {
+                    'temperature': reading.values[0],
+                    'timestamp': reading.timestamp,
+                    'age': age(name)
+                }
+        data['errors'] = dict(snapshot.errors)
+        data['errors'].update(thermocouples.errors())
     else:
         data['inside'] = {
             'temperature': -40,
@@ -117,12 +313,12 @@ async def update():
 
 
 if __name__ == '__main__':
-    video_t = threading.Thread(target=make_photo_left)
-    video_t.daemon = True
-    video_t.start()
+    # only starts the capture threads, cameras are opened when first needed,
+    # a camera process was already started above
+    cameras.start()
 
     run(app=app, port=8888, host="0.0.0.0")
 
-vs_left.stop()
+cameras.stop()
 if not dummy:
     del my_relays
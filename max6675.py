@@ -1,6 +1,20 @@
+import time
+
 from spidev import SpiDev
+from typing import Dict, Optional, Union
 
 from my_utils import get_ushort_be
+from acquisition import Reading, now
+
+
+# a read aborts the running conversion, the next one takes up to 220 ms
+CONVERSION_TIME = 0.22
+
+# hardware chip selects of the SPI bus
+CHIP_SELECTS = {
+    "CE0": 0,
+    "CE1": 1
+}
 
 
 def read_celsius(bus: SpiDev):
@@ -14,6 +28,112 @@ def read_celsius(bus: SpiDev):
     return data
 
 
+class _Channel:
+
+    def __init__(self, name: str, spi: SpiDev, gpio_pin: Optional[int]) -> None:
+        self.name = name
+        self.spi = spi
+        self.gpio_pin = gpio_pin
+        self.reading: Optional[Reading] = None
+        self.errors = 0
+        # first conversion starts at power up / chip select release
+        self.due = time.monotonic()
+
+
+class MAX6675:
+    """
+    thermocouple converters on one SPI bus
+
+    every chip is read only after its conversion finished and the cached
+    value is served in between, chips convert in parallel so all channels
+    are refreshed round-robin from one poll loop
+    """
+
+    def __init__(self, bus_num: int = 0, max_speed_hz: int = 300000) -> None:
+        self.bus_num = bus_num
+        self.max_speed_hz = max_speed_hz
+        self.channels: Dict[str, _Channel] = {}
+        self._spi: Dict[int, SpiDev] = {}
+        self._chip_select = None
+
+    def _open(self, device: int) -> SpiDev:
+        if device not in self._spi:
+            spi = SpiDev()
+            spi.open(self.bus_num, device)
+            spi.max_speed_hz = self.max_speed_hz
+            spi.mode = 0
+            self._spi[device] = spi
+        return self._spi[device]
+
+    def add_channel(self, name: str, chip_select: Union[int, str]) -> None:
+        """
+        :param chip_select: "CE0", "CE1" or GPIO number of an extra chip select
+        """
+        if name in self.channels:
+            raise ValueError(f"Thermocouple \"{name}\" already exists")
+        if chip_select in CHIP_SELECTS:
+            self.channels[name] = _Channel(name, self._open(CHIP_SELECTS[chip_select]), None)
+            return
+
+        from my_gpio import MyChipSelect
+
+        if self._chip_select is None:
+            self._chip_select = MyChipSelect()
+        pin = int(chip_select)
+        self._chip_select.add_line(pin)
+        # GPIO chip selects share the CE0 device with its own chip select disabled
+        self.channels[name] = _Channel(name, self._open(0), pin)
+
+    def _read(self, channel: _Channel) -> float:
+        if channel.gpio_pin is None:
+            return read_celsius(channel.spi)
+
+        channel.spi.no_cs = True
+        self._chip_select.select(channel.gpio_pin)
+        try:
+            return read_celsius(channel.spi)
+        finally:
+            self._chip_select.deselect(channel.gpio_pin)
+            channel.spi.no_cs = False
+
+    def poll(self) -> Dict[str, Reading]:
+        """
+        reads every channel whose conversion is finished, a failed read is
+        counted and the channel keeps its previous reading until the next one
+
+        returns:
+            {channel name: latest reading} of channels read at least once
+        """
+        for channel in self.channels.values():
+            if time.monotonic() < channel.due:
+                continue
+            try:
+                value = self._read(channel)
+            except Exception:
+                channel.errors += 1
+            else:
+                channel.reading = Reading((value, ), now())
+            channel.due = time.monotonic() + CONVERSION_TIME
+
+        return {name: channel.reading for name, channel in self.channels.items() if channel.reading is not None}
+
+    def errors(self) -> Dict[str, int]:
+        # failed reads per channel
+        return {name: channel.errors for name, channel in self.channels.items() if channel.errors}
+
+    def read_celsius(self, name: str) -> Optional[float]:
+        # cached value, None until the first conversion was read
+        reading = self.channels[name].reading
+        if reading is None:
+            return None
+        return reading.values[0]
+
+    def close(self) -> None:
+        for spi in self._spi.values():
+            spi.close()
+        self._spi.clear()
+
+
 if __name__ == '__main__':
     bus_num = 0  # RPI 4 has only 1 bus_num with number 0
     device = 0  # max6675 starts transmit on CS = 0
@@ -2,11 +2,110 @@
 
 import time
 from ctypes import c_short
+from typing import Optional
+
+import numpy as np
 from smbus2 import SMBus
 
+from calibration_cache import CalibrationCache
+from my_i2c import I2CTransaction
+
 
 MS5611_ADDRESS = 0x77
 
+# maximum ADC conversion times in seconds (datasheet, page 2)
+CONVERSION_TIMES = {
+    256: 0.60 / 1000,
+    512: 1.17 / 1000,
+    1024: 2.28 / 1000,
+    2048: 4.54 / 1000,
+    4096: 9.04 / 1000
+}
+
+# RMS resolution of pressure in mbar and temperature in C (datasheet, page 2)
+PRESSURE_RESOLUTION = {
+    256: 0.065,
+    512: 0.042,
+    1024: 0.027,
+    2048: 0.018,
+    4096: 0.012
+}
+
+TEMPERATURE_RESOLUTION = {
+    256: 0.012,
+    512: 0.008,
+    1024: 0.005,
+    2048: 0.003,
+    4096: 0.002
+}
+
+# command write + ADC read on 100 kHz I2C
+BUS_OVERHEAD = 0.5 / 1000
+
+
+def sample_time(osr_pressure: int, osr_temperature: int, temperature_interval: int = 1) -> float:
+    # average time of one pressure sample, D2 is converted once per temperature_interval samples
+    d1 = CONVERSION_TIMES[osr_pressure] + BUS_OVERHEAD
+    d2 = CONVERSION_TIMES[osr_temperature] + BUS_OVERHEAD
+    return d1 + d2 / temperature_interval
+
+
+def crc4(prom: list) -> int:
+    # CRC4 of the 8 PROM words (AN520), the result is stored in the low nibble of word 7
+    n_rem = 0
+    words = list(prom)
+    words[7] &= 0xFF00
+    for cnt in range(16):
+        if cnt % 2 == 1:
+            n_rem ^= words[cnt >> 1] & 0x00FF
+        else:
+            n_rem ^= words[cnt >> 1] >> 8
+        for _ in range(8):
+            if n_rem & 0x8000:
+                n_rem = ((n_rem << 1) ^ 0x3000) & 0xFFFF
+            else:
+                n_rem = (n_rem << 1) & 0xFFFF
+    return (n_rem >> 12) & 0x0F
+
+
+def expected_noise(osr_pressure: int, osr_temperature: int) -> tuple:
+    """
+    returns:
+        (pressure in mbar, temperature in C) RMS noise of one sample
+    """
+    return PRESSURE_RESOLUTION[osr_pressure], TEMPERATURE_RESOLUTION[osr_temperature]
+
+
+def plan_oversampling(rate: float, temperature_interval: int = 1, *,
+                      osr_pressure: Optional[int] = None, osr_temperature: Optional[int] = None) -> tuple:
+    """
+    picks the highest oversampling ratios that still fit the sample rate
+
+    pressure resolution is preferred over temperature resolution,
+    a ratio given by the caller is kept and only the other one is planned for it,
+    if even the lowest ratios do not fit, the lowest ones are returned
+
+    :param rate: target sample rate in Hz
+    :param temperature_interval: pressure samples per temperature conversion
+    :param osr_pressure: fixed pressure ratio, None to plan it
+    :param osr_temperature: fixed temperature ratio, None to plan it
+
+    returns:
+        (osr_pressure, osr_temperature, (pressure noise in mbar, temperature noise in C))
+    """
+    budget = 1.0 / rate
+    ratios = sorted(CONVERSION_TIMES, reverse=True)
+    pressure_ratios = ratios if osr_pressure is None else [osr_pressure]
+    temperature_ratios = ratios if osr_temperature is None else [osr_temperature]
+    plan = (pressure_ratios[-1], temperature_ratios[-1])
+    for pressure in pressure_ratios:
+        fitting = [temperature for temperature in temperature_ratios
+                   if sample_time(pressure, temperature, temperature_interval) <= budget]
+        if fitting:
+            plan = (pressure, fitting[0])
+            break
+    return plan + (expected_noise(*plan), )
+
 
 class MS5611:
 
@@ -26,65 +125,177 @@ class MS5611:
     CONVERT_D2_4096 = 0x58
 
     ADC_READ = 0x00
+    PROM_READ = 0xA0
+
+    # conversion states
+    IDLE = 0
+    CONVERTING_D1 = 1
+    CONVERTING_D2 = 2
+
+    CONVERT_D1 = {
+        256: CONVERT_D1_256,
+        512: CONVERT_D1_512,
+        1024: CONVERT_D1_1024,
+        2048: CONVERT_D1_2048,
+        4096: CONVERT_D1_4096
+    }
+
+    CONVERT_D2 = {
+        256: CONVERT_D2_256,
+        512: CONVERT_D2_512,
+        1024: CONVERT_D2_1024,
+        2048: CONVERT_D2_2048,
+        4096: CONVERT_D2_4096
+    }
 
-    def __init__(self, bus: SMBus) -> None:
+    def __init__(self, bus: SMBus, *, osr_pressure: int = 256, osr_temperature: int = 256,
+                 temperature_interval: int = 1, continuous: bool = False,
+                 cache: Optional[CalibrationCache] = None) -> None:
         self.bus: SMBus = bus
 
-        # Read 12 bytes of calibration data
-        # Read pressure sensitivity
+        # PROM CRC word is read first, it doubles as presence check and cache key
         try:
-            data = bus.read_i2c_block_data(0x77, 0xA2, 2)
+            crc_word = self._read_prom_word(7)
         except Exception:
             raise Exception("No MS5611 sensor on bus")
-        self.C1 = data[0] * 256 + data[1]
 
-        # Read pressure offset
-        data = bus.read_i2c_block_data(0x77, 0xA4, 2)
-        self.C2 = data[0] * 256 + data[1]
+        bus_id = getattr(bus, "bus", None)
+        prom = None
+        if cache is not None and bus_id is not None:
+            prom = cache.get(bus_id, MS5611_ADDRESS, crc_word)
+            if prom is not None and (len(prom) != 8 or crc4(prom) != prom[7] & 0x0F):
+                prom = None
+        if prom is None:
+            # all PROM words in one transaction
+            transaction = I2CTransaction()
+            for i in range(7):
+                transaction.write_read(MS5611_ADDRESS, self.PROM_READ + 2 * i, 2)
+            data = transaction.execute(bus)
+            prom = [data[2 * i] * 256 + data[2 * i + 1] for i in range(7)] + [crc_word]
+            if cache is not None and bus_id is not None and crc4(prom) == crc_word & 0x0F:
+                cache.put(bus_id, MS5611_ADDRESS, crc_word, prom)
+        self.prom = prom
 
-        # Read temperature coefficient of pressure sensitivity
-        data = bus.read_i2c_block_data(0x77, 0xA6, 2)
-        self.C3 = data[0] * 256 + data[1]
+        # pressure sensitivity, pressure offset,
+        # temperature coefficients of pressure sensitivity and pressure offset,
+        # reference temperature and temperature coefficient of the temperature
+        self.C1, self.C2, self.C3, self.C4, self.C5, self.C6 = prom[1:7]
 
-        # Read temperature coefficient of pressure offset
-        data = bus.read_i2c_block_data(0x77, 0xA8, 2)
-        self.C4 = data[0] * 256 + data[1]
+        self.osr_pressure = 256
+        self.osr_temperature = 256
+        self.set_oversampling(osr_pressure, osr_temperature)
 
-        # Read reference temperature
-        data = bus.read_i2c_block_data(0x77, 0xAA, 2)
-        self.C5 = data[0] * 256 + data[1]
+        self._adc_read = I2CTransaction()
+        self._adc_read.write_read(MS5611_ADDRESS, self.ADC_READ, 3)
 
-        # Read temperature coefficient of the temperature
-        data = bus.read_i2c_block_data(0x77, 0xAC, 2)
-        self.C6 = data[0] * 256 + data[1]
+        # conversion state machine
+        self.state = self.IDLE
+        self.ready_at = 0.0
+        self.D2: Optional[int] = None
+        self._samples_since_d2 = 0
+        # convert temperature (D2) once every N pressure samples
+        if temperature_interval < 1:
+            raise ValueError("temperature_interval must be at least 1")
+        self.temperature_interval = temperature_interval
+        # start the next sample right after the previous one was collected
+        self.continuous = continuous
+
+    def _read_prom_word(self, index: int) -> int:
+        data = self.bus.read_i2c_block_data(MS5611_ADDRESS, self.PROM_READ + 2 * index, 2)
+        return data[0] * 256 + data[1]
 
     def reset(self) -> None:
         self.bus.write_byte(MS5611_ADDRESS, self.RESET)
 
-    def read_all(self) -> tuple:
-        # MS5611_01BXXX address, 0x77(118)
-        #		0x40(64)	Pressure conversion(OSR = 256) command
-        self.bus.write_byte(0x77, self.CONVERT_D1_256)
-        time.sleep(2.1 / 1000)  # sleep 2.1 ms
+    def set_oversampling(self, pressure: Optional[int] = None, temperature: Optional[int] = None) -> None:
+        """
+        takes effect from the next started conversion
+
+        raises ValueError if oversampling ratio is not supported
+        """
+        for value in (pressure, temperature):
+            if value is not None and value not in CONVERSION_TIMES:
+                raise ValueError(f"Unsupported MS5611 oversampling ratio: {value}")
+        if pressure is not None:
+            self.osr_pressure = pressure
+        if temperature is not None:
+            self.osr_temperature = temperature
+
+    def sample_time(self) -> float:
+        """
+        returns average bus + conversion time of one sample in seconds
+        """
+        return sample_time(self.osr_pressure, self.osr_temperature, self.temperature_interval)
+
+    # ------------- Split-phase API -------------
+    def start_conversion(self) -> float:
+        """
+        starts the next ADC conversion of the current sample
+
+        returns:
+            time.monotonic() value when the result can be collected
+        """
+        if self.state == self.IDLE:
+            if self.D2 is None or self._samples_since_d2 >= self.temperature_interval:
+                self.state = self.CONVERTING_D2
+            else:
+                self.state = self.CONVERTING_D1
+
+        if self.state == self.CONVERTING_D2:
+            osr = self.osr_temperature
+            self.bus.write_byte(MS5611_ADDRESS, self.CONVERT_D2[osr])
+        else:
+            osr = self.osr_pressure
+            self.bus.write_byte(MS5611_ADDRESS, self.CONVERT_D1[osr])
+        self.ready_at = time.monotonic() + CONVERSION_TIMES[osr]
+        return self.ready_at
+
+    def conversion_ready(self) -> bool:
+        return self.state != self.IDLE and time.monotonic() >= self.ready_at
+
+    def collect(self) -> Optional[tuple]:
+        """
+        reads a finished conversion and starts the next one back to back
+
+        returns:
+            None while the sample is not complete (or conversion is still running)
+            (pressure, temperature) when D1/D2 pair was collected
+        """
+        if self.state == self.IDLE:
+            self.start_conversion()
+            return None
+        if time.monotonic() < self.ready_at:
+            return None
 
-        # Read digital pressure value
-        # Read data back from 0x00(0), 3 bytes
-        # D1 MSB2, D1 MSB1, D1 LSB
-        value = self.bus.read_i2c_block_data(0x77, 0x00, 3)
-        D1 = value[0] * 65536 + value[1] * 256 + value[2]
+        value = self._adc_read.execute(self.bus)
+        raw = value[0] * 65536 + value[1] * 256 + value[2]
 
-        # MS5611_01BXXX address, 0x76(118)
-        #		0x50(64)	Temperature conversion(OSR = 256) command
-        self.bus.write_byte(0x77, self.CONVERT_D2_256)
+        if self.state == self.CONVERTING_D2:
+            self.D2 = raw
+            self._samples_since_d2 = 0
+            self.state = self.CONVERTING_D1
+            self.start_conversion()
+            return None
 
-        time.sleep(2.1 / 1000)
+        self._samples_since_d2 += 1
+        self.state = self.IDLE
+        if self.continuous:
+            self.start_conversion()
+        return self.compensate(raw, self.D2)
+    # ------------------------------------------
 
-        # Read digital temperature value
-        # Read data back from 0x00(0), 3 bytes
-        # D2 MSB2, D2 MSB1, D2 LSB
-        value = self.bus.read_i2c_block_data(0x77, 0x00, 3)
-        D2 = value[0] * 65536 + value[1] * 256 + value[2]
+    def read_all(self) -> tuple:
+        if self.state == self.IDLE:
+            self.start_conversion()
+        while True:
+            delay = self.ready_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            result = self.collect()
+            if result is not None:
+                return result
 
+    def compensate(self, D1: int, D2: int) -> tuple:
         dT = D2 - self.C5 * 256
         TEMP = 2000 + dT * self.C6 / 8388608
         OFF = self.C2 * 65536 + (self.C4 * dT) / 128
@@ -113,6 +324,54 @@ class MS5611:
 
         return pressure, cTemp
 
+    def coefficients(self) -> dict:
+        # calibration coefficients for compensate_batch()
+        return {"C1": self.C1, "C2": self.C2, "C3": self.C3, "C4": self.C4, "C5": self.C5, "C6": self.C6}
+
+
+def compensate_batch(raw: np.ndarray, calibration: dict) -> tuple:
+    """
+    vectorized MS5611.compensate(), results are bit-for-bit equal to the scalar path
+
+    :param raw: (N, 2) array of raw D1 (pressure) and D2 (temperature) words
+    :param calibration: MS5611.coefficients()
+
+    returns:
+        (pressure, temperature) float64 arrays in hPa and C
+    """
+    raw = np.asarray(raw, dtype=np.int64)
+    D1, D2 = raw[:, 0], raw[:, 1]
+    C1, C2, C3 = calibration["C1"], calibration["C2"], calibration["C3"]
+    C4, C5, C6 = calibration["C4"], calibration["C5"], calibration["C6"]
+
+    dT = D2 - C5 * 256
+    TEMP = 2000 + dT * C6 / 8388608
+    OFF = C2 * 65536 + (C4 * dT) / 128
+    SENS = C1 * 32768 + (C3 * dT) / 256
+
+    # second order temperature compensation, only computed where it applies
+    low = np.flatnonzero(TEMP < 2000)
+    if low.size:
+        dT_low = dT[low]
+        TEMP_low = TEMP[low]
+        delta = (TEMP_low - 2000) * (TEMP_low - 2000)
+        T2 = (dT_low * dT_low) / 2147483648
+        OFF2 = 5 * delta / 2
+        SENS2 = 5 * delta / 4
+        very_low = TEMP_low < -1500
+        if very_low.any():
+            delta = (TEMP_low[very_low] + 1500) * (TEMP_low[very_low] + 1500)
+            OFF2[very_low] = OFF2[very_low] + 7 * delta
+            SENS2[very_low] = SENS2[very_low] + 11 * delta / 2
+        TEMP[low] = TEMP_low - T2
+        OFF[low] = OFF[low] - OFF2
+        SENS[low] = SENS[low] - SENS2
+
+    pressure = ((((D1 * SENS) / 2097152) - OFF) / 32768.0) / 100.0
+    cTemp = TEMP / 100.0
+
+    return pressure, cTemp
+
 
 if __name__ == "__main__":
     _bus = SMBus(1)
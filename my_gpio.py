@@ -1,9 +1,13 @@
 import lgpio as scb
 
-from typing import Union
+from typing import Callable, Dict, List, Tuple, Union
 
 
 class MyGPIO:
+    """
+    claimed line modes are tracked, so a line is only claimed again when its
+    direction changes, every claim resets an output and glitches the relay
+    """
 
     forbidden_pins = {
         "sda": 2,
@@ -18,6 +22,10 @@ class MyGPIO:
     }
 
     def __init__(self) -> None:
+        # pin -> True for output, False for input
+        self._outputs: Dict[int, bool] = {}
+        # pin -> (group leader, bit in the group) of lines claimed together
+        self._groups: Dict[int, Tuple[int, int]] = {}
         self.h = scb.gpiochip_open(0)
         if not self.h:
             return
@@ -26,28 +34,185 @@ class MyGPIO:
         scb.gpiochip_close(self.h)
 
     # ------------- Low-level API -------------
-    def _set_direction(self, pin: int, *, output: bool):
+    def _set_direction(self, pin: int, *, output: bool, level: int = 0):
         if pin not in self.forbidden_pins.values():
+            if self._outputs.get(pin) == output:
+                return
+            if pin in self._groups:
+                self._free(pin)
             if output:
-                scb.gpio_claim_output(self.h, pin)
+                scb.gpio_claim_output(self.h, pin, level)
             else:
                 scb.gpio_claim_input(self.h, pin)
+            self._outputs[pin] = output
 
     def _set_state(self, pin: int, state: bool):
         if pin not in self.forbidden_pins.values():
             if not isinstance(state, (bool, )):
                 state = bool(state)
-            scb.gpio_write(self.h, pin, int(state))
+            if pin in self._groups:
+                self._write_lines({pin: state})
+            else:
+                scb.gpio_write(self.h, pin, int(state))
 
     def _get_pin_state(self, pin: int) -> int:
         if pin not in self.forbidden_pins.values():
-            self._set_direction(pin, output=False)
+            # outputs are read back as they are, claiming them as input would release the relay
+            if pin not in self._outputs:
+                self._set_direction(pin, output=False)
             return scb.gpio_read(self.h, pin)
         else:
             return -1
+
+    def _free(self, pin: int):
+        # a line belongs to one claim only, members of a group are freed with the whole group
+        if pin in self._groups:
+            leader = self._groups[pin][0]
+            scb.group_free(self.h, leader)
+            for member in [member for member, (group, _) in self._groups.items() if group == leader]:
+                del self._groups[member]
+                del self._outputs[member]
+        elif pin in self._outputs:
+            scb.gpio_free(self.h, pin)
+            del self._outputs[pin]
+
+    def _group_conflicts(self, pins: List[int]) -> List[int]:
+        """
+        returns:
+            members of other groups which would be freed by claiming the pins as a group,
+            a group whose members are all claimed again is replaced instead
+        """
+        leaders = {self._groups[pin][0] for pin in pins if pin in self._groups}
+        return [member for member, (leader, _) in self._groups.items() if leader in leaders and member not in pins]
+
+    def _claim_group(self, pins: List[int], levels: List[int]):
+        """
+        claims the pins as one group of outputs, the first one is the group leader
+
+        raises ValueError if a pin belongs to another group which keeps other members
+        """
+        pins_levels = [(pin, level) for pin, level in zip(pins, levels) if pin not in self.forbidden_pins.values()]
+        if not pins_levels:
+            return
+        conflicts = self._group_conflicts([pin for pin, _ in pins_levels])
+        if conflicts:
+            raise ValueError(f"Pins {conflicts} would be freed with their group")
+        for pin, _ in pins_levels:
+            self._free(pin)
+        pins = [pin for pin, _ in pins_levels]
+        scb.group_claim_output(self.h, pins, [int(bool(level)) for _, level in pins_levels])
+        for bit, pin in enumerate(pins):
+            self._outputs[pin] = True
+            self._groups[pin] = (pins[0], bit)
+
+    def _write_lines(self, states: Dict[int, bool]):
+        """
+        writes several outputs, lines of one group change in the same instant with one call
+        """
+        writes: Dict[int, List[int]] = {}
+        for pin, state in states.items():
+            if pin in self.forbidden_pins.values():
+                continue
+            self._set_direction(pin, output=True, level=int(bool(state)))
+            # a line claimed alone is a group of its own
+            leader, bit = self._groups.get(pin, (pin, 0))
+            bits_mask = writes.setdefault(leader, [0, 0])
+            bits_mask[0] |= int(bool(state)) << bit
+            bits_mask[1] |= 1 << bit
+        for leader, (bits, mask) in writes.items():
+            scb.group_write(self.h, leader, bits, mask)
     # ------------------------------------------
 
 
+class MyChipSelect(MyGPIO):
+    """
+    GPIO lines used as active low SPI chip selects
+    """
+
+    def add_line(self, pin: int) -> None:
+        # claimed deselected right away, no glitch to low
+        self._set_direction(pin, output=True, level=1)
+
+    def select(self, pin: int) -> None:
+        self._set_state(pin, False)
+
+    def deselect(self, pin: int) -> None:
+        self._set_state(pin, True)
+
+
+class MyInputs(MyGPIO):
+    """
+    inputs reported by kernel edge events with debounce instead of polling
+
+    callbacks are called from the lgpio alert thread with (name, level, timestamp),
+    timestamp is the kernel time of the edge in seconds on CLOCK_MONOTONIC,
+    the same clock as acquisition.now()
+    """
+
+    edges = {
+        "rising": scb.RISING_EDGE,
+        "falling": scb.FALLING_EDGE,
+        "both": scb.BOTH_EDGES
+    }
+
+    pulls = {
+        "up": scb.SET_PULL_UP,
+        "down": scb.SET_PULL_DOWN,
+        "none": scb.SET_PULL_NONE
+    }
+
+    def __init__(self) -> None:
+        super(MyInputs, self).__init__()
+        self.pins: Dict[str, int] = {}
+        self.states: Dict[str, int] = {}
+        self._names: Dict[int, str] = {}
+        self._callbacks: List[Callable[[str, int, float], None]] = []
+        # lgpio callback objects, alerts stop when they are garbage collected
+        self._alerts = []
+
+    def add_input(self, name: str, pin: int, edge: str = "both", pull: str = "none", debounce: float = 0.005) -> int:
+        """
+        :param edge: rising, falling or both
+        :param pull: up, down or none
+        :param debounce: seconds a new level has to be stable before it is reported
+
+        returns:
+            -1 if pin is already in use
+            -2 is name is already in use
+            -3 if interface pin was provided
+
+            0 if everything is OK
+        """
+        if pin in self.forbidden_pins.values():
+            return -3
+        if pin in self._names:
+            return -1
+        if name in self.pins:
+            return -2
+        self._free(pin)
+        scb.gpio_claim_alert(self.h, pin, self.edges[edge], self.pulls[pull])
+        scb.gpio_set_debounce_micros(self.h, pin, int(debounce * 1e6))
+        # an input claim again would drop the alerts
+        self._outputs[pin] = False
+        self.pins[name] = pin
+        self._names[pin] = name
+        self.states[name] = scb.gpio_read(self.h, pin)
+        self._alerts.append(scb.callback(self.h, pin, self.edges[edge], self._on_alert))
+        return 0
+
+    def add_callback(self, callback: Callable[[str, int, float], None]) -> None:
+        self._callbacks.append(callback)
+
+    def _on_alert(self, chip: int, gpio: int, level: int, timestamp: int) -> None:
+        # level 2 is a watchdog timeout, not an edge
+        name = self._names.get(gpio)
+        if name is None or level > 1:
+            return
+        self.states[name] = level
+        for callback in self._callbacks:
+            callback(name, level, timestamp / 1e9)
+
+
 class MyRelay(MyGPIO):
 
     pins = {
@@ -60,9 +225,11 @@ class MyRelay(MyGPIO):
 
     def __init__(self) -> None:
         super(MyRelay, self).__init__()
+        # group name -> relay names switched together
+        self.groups: Dict[str, List[str]] = {}
         for k, v in self.pins.items():
-            self._set_direction(v, output=True)
-            self._set_state(v, bool(self.states[k]))
+            # claimed with its state right away, no glitch to low
+            self._set_direction(v, output=True, level=int(bool(self.states[k])))
 
     def list_relays(self):
         return list(self.pins.keys())
@@ -111,7 +278,7 @@ class MyRelay(MyGPIO):
             temp = self.pins.get(pin)
             if temp is None:
                 return
-            self.states[pin] = 1
+            self.states[pin] = 0
             pin = temp
         else:
             for pin_name, pin_num in self.pins.items():
@@ -147,6 +314,44 @@ class MyRelay(MyGPIO):
         self._set_state(pin, not bool(current_state))
         return int(not bool(current_state))
     
+    def add_group(self, group: str, relays: List[str]) -> int:
+        """
+        claims relays as one lgpio group, so set_outputs() switches them with one write
+
+        returns:
+            -1 if a relay was not found
+            -2 if a relay belongs to another group with relays not in this one
+            0 if everything is OK
+        """
+        if any(name not in self.pins for name in relays):
+            return -1
+        pins = [self.pins[name] for name in relays]
+        if self._group_conflicts(pins):
+            return -2
+        self._claim_group(pins, [self.states.get(name, 0) for name in relays])
+        # groups claimed again as a whole are replaced by this one
+        for name, members in list(self.groups.items()):
+            if set(members) <= set(relays):
+                del self.groups[name]
+        self.groups[group] = list(relays)
+        return 0
+
+    def set_outputs(self, states: Dict[str, Union[int, bool]]) -> int:
+        """
+        switches several relays at once, relays of one group change
+        in the same instant with one group write
+
+        returns:
+            -1 if a relay was not found
+            0 if everything is OK
+        """
+        if any(name not in self.pins for name in states):
+            return -1
+        self._write_lines({self.pins[name]: bool(state) for name, state in states.items()})
+        for name, state in states.items():
+            self.states[name] = int(bool(state))
+        return 0
+
     def get_pin_state(self, pin) -> int:
         """
         returns:
@@ -1,8 +1,68 @@
-from smbus2 import SMBus
+from ctypes import POINTER, addressof, c_char, c_uint8, cast
+from smbus2 import SMBus, i2c_msg
 from typing import Union
 from os.path import exists
 
 
+I2C_M_RD = 0x0001
+
+
+class I2CTransaction:
+    """
+    list of write/read messages for one or more devices
+    executed in a single i2c_rdwr kernel call
+
+    read data lands in one shared result buffer, which is reused by every
+    execution, so decode it before the next one
+    """
+
+    def __init__(self) -> None:
+        self._messages: list = []
+        self._reads: list = []  # (message index, offset, length)
+        self._size = 0
+        self.buffer = None
+        self._view = None
+
+    def write(self, address: int, data: Union[list, bytes]) -> None:
+        self._messages.append(i2c_msg.write(address, data))
+        self.buffer = None
+
+    def read(self, address: int, length: int) -> int:
+        """
+        returns:
+            offset of the data in the result buffer
+        """
+        offset = self._size
+        self._reads.append((len(self._messages), offset, length))
+        # placeholder, points into the result buffer once built
+        self._messages.append(i2c_msg(addr=address, flags=I2C_M_RD, len=length))
+        self._size += length
+        self.buffer = None
+        return offset
+
+    def write_read(self, address: int, register: int, length: int) -> int:
+        # register write followed by a repeated start read, like read_i2c_block_data
+        self.write(address, [register])
+        return self.read(address, length)
+
+    def _build(self) -> None:
+        self.buffer = (c_uint8 * max(self._size, 1))()
+        base = addressof(self.buffer)
+        for index, offset, length in self._reads:
+            self._messages[index].buf = cast(base + offset, POINTER(c_char))
+        self._view = memoryview(self.buffer).cast("B")
+
+    def execute(self, bus: SMBus) -> memoryview:
+        """
+        returns:
+            memoryview of the result buffer, no copy is made
+        """
+        if self.buffer is None:
+            self._build()
+        bus.i2c_rdwr(*self._messages)
+        return self._view
+
+
 class MyI2CBus(SMBus):
 
     def __init__(self, bus: Union[None, int, str], slave_addr = None) -> None:
@@ -27,6 +87,15 @@ class MyI2CBus(SMBus):
     def __delitem__(self, key):
         del self.devices[key]
 
+    def transaction(self) -> I2CTransaction:
+        return I2CTransaction()
+
+    def transfer(self, transaction: I2CTransaction) -> memoryview:
+        """
+        executes all messages of the transaction in one ioctl
+        """
+        return transaction.execute(self)
+
     # def load_devices(self, path: str):
     #     """
     #     uploads devices from config file
@@ -0,0 +1,329 @@
+import asyncio
+import cv2
+import os
+import tempfile
+import time
+
+from queue import Empty, Full, Queue
+from threading import Thread
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import numpy as np
+from starlette.requests import Request
+
+from async_clients import ClientQueue, watch_disconnect
+from video_stream import CameraPipeline, FramePool, RateMeter
+
+
+# Matroska element IDs
+SEGMENT = 0x18538067
+CLUSTER = 0x1F43B675
+SIMPLE_BLOCK = 0xA3
+
+
+def _vint(data: bytes, position: int, marker: bool) -> Tuple[Optional[int], int]:
+    """
+    EBML variable length integer, IDs keep their length marker, sizes do not
+
+    returns:
+        (value, position after it), None when data is incomplete,
+        -1 for the reserved unknown size
+    """
+    if position >= len(data):
+        return None, position
+    first = data[position]
+    length = 1
+    mask = 0x80
+    while length < 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if position + length > len(data):
+        return None, position
+    value = first if marker else first & (mask - 1)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+    if not marker and value == (1 << (7 * length)) - 1:
+        return -1, position + length
+    return value, position + length
+
+
+def _starts_with_keyframe(cluster: bytes, start: int) -> bool:
+    position = start
+    while position < len(cluster):
+        element, position = _vint(cluster, position, True)
+        size, position = _vint(cluster, position, False)
+        if element is None or size is None:
+            return False
+        if element == SIMPLE_BLOCK:
+            # track number, 16 bit timecode, flags
+            _, position = _vint(cluster, position, False)
+            return bool(cluster[position + 2] & 0x80)
+        position += size
+    return False
+
+
+class WebMSplitter:
+    """
+    splits a live WebM byte stream into its header and complete clusters,
+    so new clients get the header and join at the next keyframe
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._header = bytearray()
+        # EBML header, segment start, info and tracks, set with the first cluster
+        self.header: Optional[bytes] = None
+
+    def feed(self, data: bytes) -> List[Tuple[bytes, bool]]:
+        """
+        returns:
+            [(cluster, starts with a keyframe)] completed by the data
+        """
+        self._buffer += data
+        clusters = []
+        position = 0
+        while True:
+            element, content = _vint(self._buffer, position, True)
+            size, content = _vint(self._buffer, content, False) if element is not None else (None, content)
+            if element is None or size is None:
+                break
+            if element == SEGMENT:
+                # the segment of a live stream has unknown size, only its start belongs to the header
+                self._header += self._buffer[position:content]
+                position = content
+                continue
+            if size < 0:
+                raise ValueError("WebM elements of unknown size are not supported")
+            end = content + size
+            if end > len(self._buffer):
+                break
+            if element == CLUSTER:
+                if self.header is None:
+                    self.header = bytes(self._header)
+                cluster = bytes(self._buffer[position:end])
+                clusters.append((cluster, _starts_with_keyframe(cluster, content - position)))
+            elif self.header is None:
+                self._header += self._buffer[position:end]
+            # cues and tags after the clusters are of no use for a live stream
+            position = end
+        del self._buffer[:position]
+        return clusters
+
+
+class _Client(ClientQueue):
+
+    def __init__(self, queue_size: int) -> None:
+        super().__init__(queue_size)
+        # clusters are only sent from a keyframe on, after joining or falling behind
+        self.synced = False
+        self.joined = False
+
+
+class _Session:
+    # one run of the encoder, from the first client to the last one leaving
+
+    def __init__(self, encoder: "LiveEncoder") -> None:
+        self.encoder = encoder
+        self.queue: Queue = Queue(maxsize=encoder.queue_size)
+        self.pool = FramePool(encoder.queue_size + 2)
+        self.directory = tempfile.mkdtemp(prefix="live-")
+        self.fifo = os.path.join(self.directory, f"{encoder.name}.webm")
+        os.mkfifo(self.fifo)
+        self.header: Optional[bytes] = None
+        Thread(target=self._read, name=f"live-read-{encoder.name}", daemon=True).start()
+        Thread(target=self._encode, name=f"live-encode-{encoder.name}", daemon=True).start()
+
+    def _encode(self) -> None:
+        # the encoder thread holds a write end of its own for the whole session, the
+        # reader opens the pipe first thing, so this waits only until it did, and it
+        # gets the end of the stream once the muxer and this one are closed, also
+        # when the muxer never opened the pipe
+        end = os.open(self.fifo, os.O_WRONLY)
+        writer = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame, _ = item
+            if writer is None:
+                # the container is written to a pipe, so the muxer streams instead of seeking back
+                writer = cv2.VideoWriter(self.fifo, self.encoder.fourcc, self.encoder.fps,
+                                         (frame.shape[1], frame.shape[0]))
+                if not writer.isOpened():
+                    self.encoder.error = f"Can not open {self.encoder.codec} encoder"
+                    writer = None
+                    self.encoder.fail(self)
+                    break
+            started = time.perf_counter()
+            writer.write(frame)
+            self.encoder.encode_time += time.perf_counter() - started
+            self.encoder.frames += 1
+        if writer is not None:
+            writer.release()
+        os.close(end)
+
+    def close(self) -> None:
+        # called on the event loop, never blocks, queued frames make room for the end marker
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    pass
+
+    def _read(self) -> None:
+        splitter = WebMSplitter()
+        with open(self.fifo, "rb", buffering=0) as f:
+            while True:
+                data = f.read(1 << 16)
+                if not data:
+                    break
+                for cluster, keyframe in splitter.feed(data):
+                    self.header = splitter.header
+                    self.encoder.dispatch(self, cluster, keyframe)
+        os.unlink(self.fifo)
+        os.rmdir(self.directory)
+
+
+class LiveEncoder:
+    """
+    one shared inter-frame encoder of a camera for all live WebM clients
+
+    it runs only while somebody watches, gets frames like a recorder and
+    encodes them off the capture thread, the container goes through a pipe
+    and is split into clusters shared by all clients
+
+    VP8 and VP9 come with the FFmpeg of the OpenCV wheels and play in browsers,
+    H.264 does not come with them
+
+    :param pipeline: camera to encode
+    :param rendition: rendition to encode, the default one for None
+    :param codec: OpenCV fourcc
+    :param queue_size: frames waiting for the encoder before frames are dropped
+    :param client_queue: clusters waiting for a client before it has to resync at a keyframe
+    """
+
+    DEFAULT_FPS = 25.0
+
+    def __init__(self, pipeline: CameraPipeline, rendition: Optional[str] = None, codec: str = "VP80",
+                 queue_size: int = 8, client_queue: int = 8) -> None:
+        self.pipeline = pipeline
+        self.name = pipeline.name
+        self.rendition = rendition
+        self.codec = codec
+        self.fourcc = cv2.VideoWriter_fourcc(*codec)
+        # the container plays at this rate, the camera should be limited to it with fps
+        self.fps = pipeline.fps or self.DEFAULT_FPS
+        self.queue_size = queue_size
+        self.client_queue = client_queue
+        self.frames = 0
+        self.dropped = 0
+        self.encode_time = 0.0
+        self.error: Optional[str] = None
+        self.sent = RateMeter()
+        self._clients: Dict[_Client, _Session] = {}
+        self._session: Optional[_Session] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+
+    def write(self, frame: np.ndarray, timestamp: float) -> None:
+        # called by the capture thread like a recorder, never blocks
+        session = self._session
+        if session is None or session.queue.full():
+            self.dropped += 1
+            return
+        copy = session.pool.get(frame.shape)
+        np.copyto(copy, frame)
+        try:
+            session.queue.put_nowait((copy, timestamp))
+        except Full:
+            # the session is being closed
+            self.dropped += 1
+
+    def dispatch(self, session: _Session, cluster: bytes, keyframe: bool) -> None:
+        # called by the reader thread of the session
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._dispatch, session, cluster, keyframe)
+
+    def fail(self, session: _Session) -> None:
+        # called by the encoder thread of the session when the encoder can not run
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._fail, session)
+
+    def _fail(self, session: _Session) -> None:
+        # clients of the session are closed, the next client starts a new session
+        for client, client_session in list(self._clients.items()):
+            if client_session is session:
+                self._close_client(client)
+        if self._session is session:
+            self.pipeline.remove_recorder(self)
+            self._session = None
+
+    def _close_client(self, client: _Client) -> None:
+        self._clients.pop(client, None)
+        client.close()
+
+    def _dispatch(self, session: _Session, cluster: bytes, keyframe: bool) -> None:
+        for client, client_session in self._clients.items():
+            if client_session is not session:
+                continue
+            if not client.synced:
+                if not keyframe or client.qsize() + 2 > client.maxsize:
+                    continue
+                if not client.joined:
+                    client.put(session.header)
+                    client.joined = True
+                client.synced = True
+            if client.full():
+                # a dropped cluster breaks the frames after it until the next keyframe
+                client.synced = False
+                continue
+            client.put(cluster)
+
+    def _start(self) -> None:
+        self.fps = self.pipeline.fps or self.DEFAULT_FPS
+        self._session = _Session(self)
+        self.pipeline.add_recorder(self, self.rendition)
+
+    def _stop(self) -> None:
+        self.pipeline.remove_recorder(self)
+        # the encoder finishes the container and the reader cleans up
+        self._session.close()
+        self._session = None
+
+    async def stream(self, request: Request) -> AsyncIterator[bytes]:
+        """
+        async generator of the WebM stream for one client
+        """
+        if self._session is None:
+            self._start()
+        client = _Client(self.client_queue)
+        self._clients[client] = self._session
+        watcher = watch_disconnect(request, lambda: self._close_client(client))
+        try:
+            async for chunk in client:
+                self.sent.add(len(chunk))
+                yield chunk
+        finally:
+            self._clients.pop(client, None)
+            watcher.cancel()
+            if not self._clients and self._session is not None:
+                self._stop()
+
+    def stats(self) -> dict:
+        return {
+            "codec": self.codec,
+            "running": self._session is not None,
+            "clients": len(self._clients),
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "encode_time": self.encode_time / self.frames * 1000 if self.frames else None,
+            "bytes_per_second": self.sent.rate(),
+            "bytes_sent": self.sent.total,
+            "error": self.error
+        }
@@ -0,0 +1,324 @@
+import multiprocessing
+import struct
+
+from multiprocessing.shared_memory import SharedMemory
+from threading import Thread, active_count
+from typing import Dict, Optional
+
+from video_stream import CameraPipeline, FrameBroadcaster, default_rendition, rendition_options, rendition_stats
+
+
+# header fields, each one has a single writer process
+SEQUENCE = 0  # Q, latest frame (capture process)
+FRAMES = 8  # Q, captured frames (capture process)
+IDLE_FRAMES = 16  # Q, keep-alive frames (capture process)
+SLOTS = 24  # I
+SLOT_SIZE = 28  # I
+DEMAND = 32  # I, somebody is watching (web process)
+OPEN = 36  # I, camera is open (capture process)
+UNCHANGED = 40  # Q, frames not encoded because nothing changed (capture process)
+HEADER_SIZE = 64
+# sequence, length
+SLOT_HEADER = struct.Struct("<QI")
+SLOT_HEADER_SIZE = 16
+
+
+class FrameRing:
+    """
+    ring buffer of encoded frames in shared memory
+
+    every slot carries the sequence of its frame, the writer invalidates it
+    before overwriting, so readers detect a frame replaced while they copied it
+    """
+
+    def __init__(self, name: Optional[str] = None, slots: int = 8, slot_size: int = 1 << 20) -> None:
+        if name is None:
+            self.shm = SharedMemory(create=True, size=HEADER_SIZE + slots * (SLOT_HEADER_SIZE + slot_size))
+            self.shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+            struct.pack_into("<II", self.shm.buf, SLOTS, slots, slot_size)
+        else:
+            self.shm = SharedMemory(name=name)
+        self.buf = self.shm.buf
+        self.slots, self.slot_size = struct.unpack_from("<II", self.buf, SLOTS)
+        self.oversized = 0
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def sequence(self) -> int:
+        return struct.unpack_from("<Q", self.buf, SEQUENCE)[0]
+
+    def counters(self) -> tuple:
+        # (frames, idle frames, unchanged frames) of the capture process
+        return struct.unpack_from("<QQ", self.buf, FRAMES) + struct.unpack_from("<Q", self.buf, UNCHANGED)
+
+    def set_counters(self, frames: int, idle_frames: int, unchanged: int) -> None:
+        struct.pack_into("<QQ", self.buf, FRAMES, frames, idle_frames)
+        struct.pack_into("<Q", self.buf, UNCHANGED, unchanged)
+
+    @property
+    def open(self) -> bool:
+        return bool(struct.unpack_from("<I", self.buf, OPEN)[0])
+
+    @open.setter
+    def open(self, value: bool) -> None:
+        struct.pack_into("<I", self.buf, OPEN, int(value))
+
+    @property
+    def demand(self) -> bool:
+        return bool(struct.unpack_from("<I", self.buf, DEMAND)[0])
+
+    @demand.setter
+    def demand(self, value: bool) -> None:
+        struct.pack_into("<I", self.buf, DEMAND, int(value))
+
+    def _offset(self, sequence: int) -> int:
+        return HEADER_SIZE + (sequence % self.slots) * (SLOT_HEADER_SIZE + self.slot_size)
+
+    def write(self, chunk: bytes) -> int:
+        """
+        returns:
+            sequence of the written frame, 0 if it does not fit a slot
+        """
+        if len(chunk) > self.slot_size:
+            self.oversized += 1
+            return 0
+        sequence = self.sequence + 1
+        offset = self._offset(sequence)
+        SLOT_HEADER.pack_into(self.buf, offset, 0, 0)
+        start = offset + SLOT_HEADER_SIZE
+        self.buf[start:start + len(chunk)] = chunk
+        SLOT_HEADER.pack_into(self.buf, offset, sequence, len(chunk))
+        struct.pack_into("<Q", self.buf, SEQUENCE, sequence)
+        return sequence
+
+    def read(self, sequence: int) -> Optional[bytes]:
+        """
+        returns:
+            frame with the given sequence, None if it was already overwritten
+        """
+        offset = self._offset(sequence)
+        slot_sequence, length = SLOT_HEADER.unpack_from(self.buf, offset)
+        if slot_sequence != sequence:
+            return None
+        start = offset + SLOT_HEADER_SIZE
+        # the only copy of the frame in the web process, shared by all its clients
+        chunk = bytes(self.buf[start:start + length])
+        if SLOT_HEADER.unpack_from(self.buf, offset)[0] != sequence:
+            return None
+        return chunk
+
+    def close(self) -> None:
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self) -> None:
+        self.shm.unlink()
+
+
+class _RingBroadcaster(FrameBroadcaster):
+    # capture process side, encoded frames go to the ring instead of clients
+
+    def __init__(self, ring: FrameRing, connection, rendition: str, quality: int) -> None:
+        super().__init__(quality=quality)
+        self.ring = ring
+        self.connection = connection
+        self.rendition = rendition
+
+    @property
+    def wanted(self) -> bool:
+        # clients subscribe in the web process
+        return self.ring.demand
+
+    def publish_encoded(self, chunk: bytes) -> None:
+        sequence = self.ring.write(chunk)
+        if sequence:
+            # only the rendition and sequence number travel through the pipe
+            self.connection.send((self.rendition, sequence))
+
+
+def _renditions(options: dict) -> Dict[str, tuple]:
+    # renditions of camera options as in config.cameras
+    return rendition_options(options.get("width", 400), options.get("renditions"))
+
+
+def _capture_process(cameras: Dict[str, dict], rings: Dict[str, Dict[str, FrameRing]],
+                     connections: dict, recording: Optional[dict], stop) -> None:
+    # forked child, rings are inherited mappings of the same shared memory
+    pipelines = {}
+    recorders = []
+    for name, options in cameras.items():
+        pipeline = CameraPipeline(name, **options)
+        for rendition, (_, quality) in _renditions(options).items():
+            pipeline.renditions[rendition] = _RingBroadcaster(rings[name][rendition], connections[name],
+                                                              rendition, quality)
+        pipeline.start()
+        if recording:
+            from video_recorder import start_recording
+            recorders.append(start_recording(pipeline, recording))
+        pipelines[name] = pipeline
+
+    # demand of the web process clients is polled from the ring headers,
+    # camera counters are kept in the ring of the default rendition
+    while not stop.wait(0.02):
+        for pipeline in pipelines.values():
+            pipeline.update_demand()
+            ring = pipeline.broadcaster.ring
+            ring.set_counters(pipeline.frames, pipeline.idle_frames, pipeline.unchanged)
+            ring.open = pipeline.stats()["open"]
+
+    for name, pipeline in pipelines.items():
+        pipeline.stop()
+        connections[name].close()
+    for recorder in recorders:
+        recorder.stop()
+
+
+class _RemoteCamera:
+    # web process side of one camera, mirrors the rings into local broadcasters
+
+    def __init__(self, name: str, rings: Dict[str, FrameRing], connection, renditions: Dict[str, tuple]) -> None:
+        self.name = name
+        self.rings = rings
+        self.connection = connection
+        self.renditions: Dict[str, FrameBroadcaster] = {}
+        for rendition, (_, quality) in renditions.items():
+            broadcaster = FrameBroadcaster(quality=quality)
+            broadcaster.on_demand = self._demand_setter(rings[rendition])
+            self.renditions[rendition] = broadcaster
+        self.default = default_rendition(self.renditions)
+        self.skipped = 0
+        self._thread = Thread(target=self._receive, name=f"camera-{name}", daemon=True)
+
+    @staticmethod
+    def _demand_setter(ring: FrameRing):
+        def on_demand(subscribers: int) -> None:
+            ring.demand = subscribers > 0
+        return on_demand
+
+    @property
+    def broadcaster(self) -> FrameBroadcaster:
+        return self.renditions[self.default]
+
+    def rendition(self, name: Optional[str] = None) -> FrameBroadcaster:
+        return self.renditions[name or self.default]
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _receive(self) -> None:
+        while True:
+            try:
+                messages = [self.connection.recv()]
+                # skip to the newest frame of every rendition if several are waiting
+                while self.connection.poll():
+                    messages.append(self.connection.recv())
+            except (EOFError, OSError):
+                break
+            newest = dict(messages)
+            self.skipped += len(messages) - len(newest)
+            for rendition, sequence in newest.items():
+                chunk = self.rings[rendition].read(sequence)
+                if chunk is None:
+                    self.skipped += 1
+                    continue
+                self.renditions[rendition].publish_encoded(chunk)
+
+    def stats(self) -> dict:
+        ring = self.rings[self.default]
+        frames, idle_frames, unchanged = ring.counters()
+        return {
+            "active": any(ring.demand for ring in self.rings.values()),
+            "open": ring.open,
+            "frames": frames,
+            "idle_frames": idle_frames,
+            "unchanged": unchanged,
+            "renditions": {name: rendition_stats(broadcaster) for name, broadcaster in self.renditions.items()},
+            "skipped": self.skipped
+        }
+
+
+class CameraProcess:
+    """
+    runs capture, resize, overlay and encoding of all cameras in a child
+    process, so they never compete with the web server for the GIL
+
+    encoded frames are published through shared memory rings, the same
+    interface as CameraPool is offered to the web server, recorders run
+    in the child process too
+
+    the child is forked, so start() has to be called before any other thread
+    exists (bus workers, acquisition, GPIO alerts, the server), a lock held by
+    one of them at fork time would stay locked in the child forever
+    """
+
+    def __init__(self, cameras: Dict[str, dict], slots: int = 8, slot_size: int = 1 << 20,
+                 recording: Optional[dict] = None) -> None:
+        self.cameras = cameras
+        self.recording = recording
+        self.rings = {
+            name: {rendition: FrameRing(slots=slots, slot_size=slot_size) for rendition in _renditions(options)}
+            for name, options in cameras.items()
+        }
+        self.pipelines: Dict[str, _RemoteCamera] = {}
+        self._connections = {}
+        # fork, the server module sets up hardware at import and must not run again in the
+        # child, which spawn and forkserver do by importing the main module again
+        self._context = multiprocessing.get_context("fork")
+        for name, options in cameras.items():
+            receiver, sender = self._context.Pipe(duplex=False)
+            self._connections[name] = sender
+            self.pipelines[name] = _RemoteCamera(name, self.rings[name], receiver, _renditions(options))
+        self._stop = self._context.Event()
+        self._process = None
+        # live WebM streams need the frames in this process, see CameraPool
+        self.live: dict = {}
+
+    def __getitem__(self, name: str) -> _RemoteCamera:
+        return self.pipelines[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.pipelines
+
+    def names(self) -> list:
+        return list(self.pipelines.keys())
+
+    def attach(self, loop) -> None:
+        for pipeline in self.pipelines.values():
+            for broadcaster in pipeline.renditions.values():
+                broadcaster.attach(loop)
+
+    def start(self) -> None:
+        if self._process is not None:
+            return
+        if active_count() > 1:
+            raise RuntimeError("CameraProcess has to be started before any other thread")
+        self._process = self._context.Process(
+            target=_capture_process,
+            args=(self.cameras, self.rings, self._connections, self.recording, self._stop),
+            name="video",
+            daemon=True
+        )
+        self._process.start()
+        # only the child writes to the pipes, from here on threads may be started
+        for connection in self._connections.values():
+            connection.close()
+        for pipeline in self.pipelines.values():
+            pipeline.start()
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._stop.set()
+            self._process.join()
+            self._process = None
+        for pipeline in self.pipelines.values():
+            pipeline.connection.close()
+        for rings in self.rings.values():
+            for ring in rings.values():
+                ring.close()
+                ring.unlink()
+
+    def stats(self) -> dict:
+        return {name: pipeline.stats() for name, pipeline in self.pipelines.items()}
@@ -0,0 +1,212 @@
+import cv2
+import datetime
+import os
+import time
+
+from queue import Full, Queue
+from threading import Thread
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from acquisition import now
+from video_stream import CameraPipeline, FramePool
+
+
+class VideoRecorder:
+    """
+    records frames of one camera to rotating segments with an inter-frame codec
+
+    frames are copied into a fixed pool and encoded in an own thread, when the
+    encoder falls behind frames are dropped from the recording, never from the
+    live streams
+
+    every segment <camera>_<wall clock start>.mp4 has an index <camera>_<start>.index with
+    the timestamp of every frame, taken with acquisition.now() like sensor readings,
+    so a time range is found and seeked without decoding from the start
+
+    :param name: camera name, prefix of the segment files
+    :param directory: directory of the segments
+    :param fps: nominal frame rate written to the container, real times are in the index
+    :param segment_time: seconds per segment
+    :param codec: OpenCV fourcc
+    :param queue_size: frames waiting for the encoder before frames are dropped
+    """
+
+    EXTENSION = ".mp4"
+    INDEX_EXTENSION = ".index"
+    DEFAULT_FPS = 25.0
+
+    def __init__(self, name: str, directory: str, fps: float = DEFAULT_FPS, segment_time: float = 300.0,
+                 codec: str = "mp4v", queue_size: int = 32) -> None:
+        self.name = name
+        self.directory = directory
+        self.fps = fps
+        self.segment_time = segment_time
+        self.fourcc = cv2.VideoWriter_fourcc(*codec)
+        self._queue: Queue = Queue(maxsize=queue_size)
+        # queued frames, one being encoded and one being copied
+        self._pool = FramePool(queue_size + 2)
+        self.frames = 0
+        self.dropped = 0
+        self.segments = 0
+        self.segment: Optional[str] = None
+        self.error: Optional[str] = None
+        self._writer: Optional[cv2.VideoWriter] = None
+        self._index = None
+        self._segment_start = 0.0
+        self._segment_frames = 0
+        self._frame_size: Optional[Tuple[int, int]] = None
+        self._thread: Optional[Thread] = None
+
+    def write(self, frame: np.ndarray, timestamp: float) -> None:
+        """
+        queues a copy of the frame, called by the capture thread, never blocks
+        """
+        if self._queue.full():
+            self.dropped += 1
+            return
+        copy = self._pool.get(frame.shape)
+        np.copyto(copy, frame)
+        try:
+            self._queue.put_nowait((copy, timestamp))
+        except Full:
+            self.dropped += 1
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = Thread(target=self._run, name=f"recorder-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "queue_depth": self._queue.qsize(),
+            "segments": self.segments,
+            "segment": self.segment,
+            "error": self.error
+        }
+
+    def _open_segment(self, frame: np.ndarray, timestamp: float) -> None:
+        self._close_segment()
+        start = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        base = os.path.join(self.directory, f"{self.name}_{start}")
+        self.segment = base + self.EXTENSION
+        self._frame_size = (frame.shape[1], frame.shape[0])
+        self._writer = cv2.VideoWriter(self.segment, self.fourcc, self.fps, self._frame_size)
+        if not self._writer.isOpened():
+            self._writer = None
+            raise IOError(f"Can not open video writer for \"{self.segment}\"")
+        self._index = open(base + self.INDEX_EXTENSION, "w")
+        # relates the monotonic reading clock to the wall clock
+        self._index.write(f"# clock {now():.6f} time {time.time():.6f}\n")
+        self._segment_start = timestamp
+        self._segment_frames = 0
+        self.segments += 1
+
+    def _close_segment(self) -> None:
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            frame, timestamp = item
+            if (self._writer is None or timestamp - self._segment_start >= self.segment_time
+                    or self._frame_size != (frame.shape[1], frame.shape[0])):
+                try:
+                    self._open_segment(frame, timestamp)
+                except IOError as e:
+                    # retried with the next frame
+                    self.error = str(e)
+                    self.dropped += 1
+                    continue
+                self.error = None
+            self._writer.write(frame)
+            # frame number in the segment and its timestamp
+            self._index.write(f"{self._segment_frames} {timestamp:.6f}\n")
+            self._index.flush()
+            self._segment_frames += 1
+            self.frames += 1
+        self._close_segment()
+
+    # ------------- seeking -------------
+    def _indexes(self) -> List[str]:
+        return sorted(os.path.join(self.directory, file) for file in os.listdir(self.directory)
+                      if file.startswith(self.name + "_") and file.endswith(self.INDEX_EXTENSION))
+
+    def find(self, start: float, end: float) -> List[Tuple[str, int, int]]:
+        """
+        :param start: first timestamp, same clock as the sensor readings
+        :param end: last timestamp
+
+        the clock restarts with every boot, the header of every index relates it to the wall clock
+
+        returns:
+            [(segment path, first frame, last frame)] of frames within the range
+        """
+        ranges = []
+        for index in self._indexes():
+            first = last = None
+            with open(index) as f:
+                for line in f:
+                    if line.startswith("#"):
+                        continue
+                    frame, timestamp = line.split()
+                    timestamp = float(timestamp)
+                    if timestamp > end:
+                        break
+                    if timestamp >= start:
+                        if first is None:
+                            first = int(frame)
+                        last = int(frame)
+            if first is not None:
+                ranges.append((index[:-len(self.INDEX_EXTENSION)] + self.EXTENSION, first, last))
+        return ranges
+
+    def read(self, start: float, end: float) -> Iterator[np.ndarray]:
+        """
+        generator of the recorded frames within the time range, every segment
+        is seeked to the first frame instead of decoded from its start
+        """
+        for segment, first, last in self.find(start, end):
+            capture = cv2.VideoCapture(segment)
+            capture.set(cv2.CAP_PROP_POS_FRAMES, first)
+            for _ in range(last - first + 1):
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield frame
+            capture.release()
+    # -----------------------------------
+
+
+def start_recording(pipeline: CameraPipeline, recording: dict) -> VideoRecorder:
+    """
+    records a rendition of the pipeline, see config.recording
+
+    returns:
+        started recorder
+    """
+    options = dict(recording)
+    rendition = options.pop("rendition", None)
+    recorder = VideoRecorder(pipeline.name, fps=pipeline.fps or VideoRecorder.DEFAULT_FPS, **options)
+    recorder.start()
+    pipeline.add_recorder(recorder, rendition)
+    return recorder
@@ -1,116 +1,677 @@
-import imutils
+import asyncio
 import cv2
 import datetime
+import numpy as np
 import time
 
-from threading import Lock
+from collections import deque
+from threading import Condition, Event, Lock, Thread
+from typing import AsyncIterator, Callable, Dict, Optional, Set, Tuple, Union
+
+from starlette.requests import Request
 
 from imutils.video import VideoStream
 
-# left cam
-output_frame_left, lock_left = None, Lock()
-vs_left = VideoStream(src=0).start()
-time.sleep(2)
-# --------------------------------
-
-
-# right cam
-# output_frame_right, lock_right = None, Lock()
-# vs_right = VideoStream(usePiCamera=True).start()
-# time.sleep(2)
-# --------------------------------
-
-
-def make_photo_left():
-    global vs_left, output_frame_left, lock_left
-    total = 0
-    # loop over frames from the video stream
-    while True:
-        # read the next frame from the video stream, resize it,
-        # convert the frame to grayscale, and blur it
-        frame = vs_left.read()
-        frame = imutils.resize(frame, width=400)
-        # grab the current timestamp and draw it on the frame
-        timestamp = datetime.datetime.now()
-        cv2.putText(frame, timestamp.strftime(
-            "%A %d %B %Y %I:%M:%S%p"), (10, frame.shape[0] - 10),
-            cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
-
-        total += 1
-        # acquire the lock, set the output frame, and release the
-        # lock
-        with lock_left:
-            output_frame_left = frame.copy()
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            print('break')
-            break
-
-
-def generate_left():
-    # grab global references to the output frame and lock variables
-    global vs_left, output_frame_left, lock_left
-    # loop over frames from the output stream
-
-    while True:
-        # wait until the lock is acquired
-        with lock_left:
-            # check if the output frame is available, otherwise skip
-            # the iteration of the loop
-            if output_frame_left is None:
+from acquisition import now
+from async_clients import ClientQueue, watch_disconnect
+
+
+# OpenCV default JPEG quality
+DEFAULT_QUALITY = 95
+
+
+# size of the grayscale copy compared by the change detector
+DETECTOR_SIZE = (64, 48)
+# multipart framing of every encoded frame
+CHUNK_HEADER = b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n'
+CHUNK_TRAILER = b'\r\n'
+
+
+def rendition_options(width: int, renditions: Optional[Dict[str, Tuple[int, int]]] = None) -> Dict[str, Tuple[int, int]]:
+    # {rendition: (width, JPEG quality)}, a single "standard" one without renditions
+    return renditions or {"standard": (width, DEFAULT_QUALITY)}
+
+
+def default_rendition(renditions) -> str:
+    # rendition served when a client does not ask for one
+    return "standard" if "standard" in renditions else next(iter(renditions))
+
+
+class RateMeter:
+    """
+    bytes per second sent to clients over the last WINDOW seconds
+    """
+
+    WINDOW = 5.0
+
+    def __init__(self) -> None:
+        self.total = 0
+        self._history: deque = deque()
+
+    def add(self, count: int) -> None:
+        current = time.monotonic()
+        self.total += count
+        self._history.append((current, count))
+        self._trim(current)
+
+    def _trim(self, current: float) -> None:
+        while self._history and self._history[0][0] < current - self.WINDOW:
+            self._history.popleft()
+
+    def rate(self) -> float:
+        self._trim(time.monotonic())
+        return sum(count for _, count in self._history) / self.WINDOW
+
+
+class FrameBroadcaster:
+    """
+    encodes every published frame exactly once and shares the encoded
+    multipart chunk with all clients
+
+    each frame gets a sequence number, clients only get a frame when
+    a newer sequence than the one they already sent is available
+
+    asyncio clients get their own bounded queue, when a slow client falls
+    behind its oldest frame is dropped, so it skips frames instead of
+    slowing the others down
+    """
+
+    def __init__(self, queue_size: int = 2, quality: int = DEFAULT_QUALITY) -> None:
+        self._condition = Condition()
+        self.sequence = 0
+        self.chunk: Optional[bytes] = None
+        self.queue_size = queue_size
+        self.quality = quality
+        # time of the latest frame and its JPEG cut out of the chunk on first request
+        self.published_at = 0.0
+        self._jpeg: Tuple[int, Optional[bytes]] = (0, None)
+        # distinguishes sequence numbers of different server runs, e.g. in ETags
+        self.epoch = format(time.time_ns(), "x")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._clients: Set[ClientQueue] = set()
+        # snapshot requests waiting for the next frame
+        self._waiters: Set[asyncio.Future] = set()
+        self.dropped = 0
+        self.sent = RateMeter()
+        # everyone who needs frames: stream clients, recorders, ...
+        self.subscribers = 0
+        self._subscribers_lock = Lock()
+        # called with the new subscriber count whenever it changes
+        self.on_demand: Optional[Callable[[int], None]] = None
+
+    def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        # event loop of the asyncio clients
+        self._loop = loop
+
+    @property
+    def clients(self) -> int:
+        return len(self._clients)
+
+    @property
+    def wanted(self) -> bool:
+        # somebody needs frames of this broadcaster
+        return self.subscribers > 0
+
+    def subscribe(self) -> None:
+        with self._subscribers_lock:
+            self.subscribers += 1
+            count = self.subscribers
+        if self.on_demand is not None:
+            self.on_demand(count)
+
+    def unsubscribe(self) -> None:
+        with self._subscribers_lock:
+            self.subscribers -= 1
+            count = self.subscribers
+        if self.on_demand is not None:
+            self.on_demand(count)
+
+    def publish(self, frame) -> None:
+        # encoding happens outside the lock, so clients never block the capture thread
+        flag, encoded_image = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not flag:
+            return
+        # the only copy of the encoded image, straight into the multipart chunk
+        self.publish_encoded(b"".join((CHUNK_HEADER, encoded_image.data, CHUNK_TRAILER)))
+
+    def publish_encoded(self, chunk: bytes) -> None:
+        # shares an already encoded multipart chunk
+        with self._condition:
+            self.sequence += 1
+            self.chunk = chunk
+            self.published_at = time.monotonic()
+            self._condition.notify_all()
+
+        if self._loop is not None and (self._clients or self._waiters):
+            try:
+                self._loop.call_soon_threadsafe(self._dispatch, chunk)
+            except RuntimeError:
+                # event loop is already closed
+                self._loop = None
+
+    def wait(self, last_sequence: int, timeout: Optional[float] = None) -> Tuple[int, Optional[bytes]]:
+        """
+        blocks until a frame newer than last_sequence is published
+
+        returns:
+            (sequence, chunk), unchanged last_sequence and None on timeout
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.sequence != last_sequence, timeout):
+                return last_sequence, None
+            return self.sequence, self.chunk
+
+    def jpeg(self) -> Tuple[int, Optional[bytes]]:
+        """
+        latest encoded frame without multipart framing, copied once per frame
+        and only when asked for, never encoded again
+
+        returns:
+            (sequence, JPEG), None before the first frame
+        """
+        with self._condition:
+            sequence, chunk = self.sequence, self.chunk
+        if chunk is None:
+            return sequence, None
+        if self._jpeg[0] != sequence:
+            self._jpeg = (sequence, chunk[len(CHUNK_HEADER):-len(CHUNK_TRAILER)])
+        return self._jpeg
+
+    async def latest(self, max_age: float, timeout: float) -> Tuple[int, Optional[bytes]]:
+        """
+        latest encoded frame, a new one is requested from the camera when
+        there is none or it is older than max_age seconds (nobody watches)
+
+        returns:
+            (sequence, JPEG), None when the camera delivers nothing within timeout
+        """
+        if self.chunk is None or time.monotonic() - self.published_at > max_age:
+            # woken up by the next published frame, no thread is held while waiting
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.add(waiter)
+            # a subscriber for one frame, the capture resumes and encodes it right away
+            self.subscribe()
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiters.discard(waiter)
+                self.unsubscribe()
+        return self.jpeg()
+
+    # ------------- asyncio clients -------------
+    def _dispatch(self, chunk: bytes) -> None:
+        for client in self._clients:
+            if client.put(chunk):
+                self.dropped += 1
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _disconnect(self, client: ClientQueue) -> None:
+        self._clients.discard(client)
+        client.close()
+
+    async def stream(self, request: Request) -> AsyncIterator[bytes]:
+        """
+        async generator of multipart chunks for one client
+        """
+        client = ClientQueue(self.queue_size)
+        if self.chunk is not None:
+            client.put(self.chunk)
+        self._clients.add(client)
+        self.subscribe()
+        watcher = watch_disconnect(request, lambda: self._disconnect(client))
+        try:
+            async for chunk in client:
+                self.sent.add(len(chunk))
+                yield chunk
+        finally:
+            self._clients.discard(client)
+            self.unsubscribe()
+            watcher.cancel()
+    # ------------------------------------------
+
+
+class FramePool:
+    """
+    fixed set of reusable frame buffers handed out round robin
+
+    a buffer is only handed out again after all the others were,
+    consumers keeping a frame longer than that have to copy it
+    """
+
+    def __init__(self, count: int = 2) -> None:
+        self._buffers: list = [None] * count
+        self._next = 0
+        # buffers allocated so far, stays constant while the frame size does
+        self.allocations = 0
+
+    def get(self, shape: Tuple[int, ...]) -> np.ndarray:
+        buffer = self._buffers[self._next]
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, np.uint8)
+            self._buffers[self._next] = buffer
+            self.allocations += 1
+        self._next = (self._next + 1) % len(self._buffers)
+        return buffer
+
+
+class CameraPipeline:
+    """
+    one camera with its own capture thread, every captured frame feeds
+    several renditions with own size and JPEG quality
+
+    :param source: USB camera index or "picamera"
+    :param width: width of the served frames without renditions, height keeps the aspect ratio
+    :param resolution: capture resolution (width, height), None for camera default
+    :param fps: capture rate limit, 0 for as fast as possible
+    :param idle_fps: keep-alive rate without subscribers, 0 suspends the capture
+    :param change_threshold: gray level difference of any block of the downscaled frame
+        needed to encode a frame, 0 encodes every frame
+    :param keepalive: seconds after which an unchanged frame is encoded anyway
+    :param preload: open the camera right after start instead of on the first needed frame
+    :param idle_timeout: seconds without a needed frame after which the camera is closed,
+        0 keeps it open
+    :param renditions: {name: (width, JPEG quality)}, width 0 keeps the captured size,
+        defaults to {"standard": (width, DEFAULT_QUALITY)}
+
+    the camera is opened and warmed up in the capture thread, so start() never
+    blocks and a missing camera only shows up in stats()
+
+    a rendition is only resized and encoded while somebody subscribes to it,
+    recorders get every captured frame of their rendition, changed or not,
+    keep-alive frames only go to the default rendition, the camera stays open
+    for idle_timeout after the last needed frame so capture resumes right away,
+    it is closed after that and its reader thread stops decoding frames
+    """
+
+    WARMUP_TIME = 2.0
+    # delay before opening a failed camera again
+    RETRY_TIME = 5.0
+    # wait between reads while the camera has no new frame
+    FRAME_POLL_TIME = 0.005
+    # longest wait for the reader thread to finish its read before releasing the camera
+    RELEASE_TIMEOUT = 1.0
+
+    def __init__(self, name: str, source: Union[int, str] = 0, width: int = 400,
+                 resolution: Optional[Tuple[int, int]] = None, fps: float = 0, idle_fps: float = 0,
+                 change_threshold: float = 0, keepalive: float = 1.0, preload: bool = False, renditions: Optional[Dict[str, Tuple[int, int]]] = None,
+                 idle_timeout: float = 30.0) -> None:
+        self.name = name
+        self.source = source
+        self.resolution = resolution
+        self.fps = fps
+        self.idle_fps = idle_fps
+        self.preload = preload
+        self.idle_timeout = idle_timeout
+        self.change_threshold = change_threshold
+        self.keepalive = keepalive
+        # change detector buffers, the reference is one of the two gray ones
+        self._small = np.empty(DETECTOR_SIZE[::-1] + (3, ), np.uint8)
+        self._gray = (np.empty(DETECTOR_SIZE[::-1], np.uint8), np.empty(DETECTOR_SIZE[::-1], np.uint8))
+        self._difference = np.empty(DETECTOR_SIZE[::-1], np.uint8)
+        self._reference: Optional[np.ndarray] = None
+        # last encoding time of every rendition
+        self._published: Dict[str, float] = {}
+        renditions = rendition_options(width, renditions)
+        self.widths = {rendition: rendition_width for rendition, (rendition_width, _) in renditions.items()}
+        self.renditions: Dict[str, FrameBroadcaster] = {}
+        for rendition, (_, quality) in renditions.items():
+            broadcaster = FrameBroadcaster(quality=quality)
+            broadcaster.on_demand = self.update_demand
+            self.renditions[rendition] = broadcaster
+        self.default = default_rendition(self.renditions)
+        # resized and overlaid frames of every rendition
+        self.pools = {rendition: FramePool() for rendition in self.renditions}
+        # recorders of every rendition, see video_recorder
+        self.recorders: Dict[str, list] = {rendition: [] for rendition in self.renditions}
+        self.frames = 0
+        self.idle_frames = 0
+        # frames not encoded because nothing changed
+        self.unchanged = 0
+        # time it took to open and warm up the camera, error of the last attempt
+        self.open_time: Optional[float] = None
+        self.error: Optional[str] = None
+        self._demand = Event()
+        self._stream = None
+        self._reader: Optional[Thread] = None
+        # latest processed frame, the readers hand out a new array for every frame
+        self._frame = None
+        # time of the latest processed frame
+        self._used_at = 0.0
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def _open(self) -> None:
+        if self.source == "picamera":
+            kwargs = {"usePiCamera": True}
+            if self.resolution is not None:
+                kwargs["resolution"] = self.resolution
+            if self.fps:
+                kwargs["framerate"] = int(self.fps)
+            self._stream = VideoStream(**kwargs).start()
+        else:
+            # the reader thread is started here, imutils keeps no reference
+            # to join it before the camera is released
+            self._stream = VideoStream(src=int(self.source)).stream
+            # imutils does not raise for a missing camera
+            capture = self._stream.stream
+            if not capture.isOpened():
+                raise IOError(f"Can not open camera {self.source}")
+            if self.resolution is not None:
+                capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+                capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+            self._reader = Thread(target=self._stream.update, name=f"camera-{self.name}-reader", daemon=True)
+            self._reader.start()
+        self._stop.wait(self.WARMUP_TIME)
+        if self._stream.read() is None and not self._stop.is_set():
+            raise IOError(f"No frame from camera {self.source}")
+
+    def _close(self) -> None:
+        if self._stream is not None:
+            # the picamera reader closes the camera itself once stopped
+            self._stream.stop()
+            if self._reader is not None:
+                self._reader.join(self.RELEASE_TIMEOUT)
+                # a reader stuck in a read still uses the capture
+                if not self._reader.is_alive():
+                    self._stream.stream.release()
+                self._reader = None
+            elif self.source != "picamera":
+                # failed before the reader was started
+                self._stream.stream.release()
+            self._stream = None
+            self._frame = None
+
+    def _ensure_open(self) -> bool:
+        """
+        returns:
+            True when the camera is open and warmed up
+        """
+        if self._stream is not None:
+            return True
+        started = time.monotonic()
+        try:
+            self._open()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self._close()
+            self._stop.wait(self.RETRY_TIME)
+            return False
+        self.open_time = time.monotonic() - started
+        self.error = None
+        return True
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._capture, name=f"camera-{self.name}", daemon=True)
+        self._thread.start()
+
+    @property
+    def broadcaster(self) -> FrameBroadcaster:
+        return self.renditions[self.default]
+
+    def rendition(self, name: Optional[str] = None) -> FrameBroadcaster:
+        """
+        returns:
+            broadcaster of the rendition, the default one for None
+
+        raises:
+            KeyError for an unknown rendition
+        """
+        return self.renditions[name or self.default]
+
+    def add_recorder(self, recorder, rendition: Optional[str] = None) -> None:
+        """
+        :param recorder: object with write(frame, timestamp), gets every captured frame
+            of the rendition, the frame buffer is reused, so it has to be copied
+        :param rendition: rendition to record, the default one for None
+        """
+        self.recorders[rendition or self.default].append(recorder)
+        self.update_demand()
+
+    def remove_recorder(self, recorder) -> None:
+        for recorders in self.recorders.values():
+            if recorder in recorders:
+                recorders.remove(recorder)
+        self.update_demand()
+
+    def update_demand(self, _: int = 0) -> None:
+        # wanted renditions and recorders keep the capture running
+        self.set_demand(sum(broadcaster.wanted for broadcaster in self.renditions.values())
+                        + sum(len(recorders) for recorders in self.recorders.values()))
+
+    def set_demand(self, subscribers: int) -> None:
+        if subscribers > 0:
+            self._demand.set()
+        else:
+            self._demand.clear()
+
+    @property
+    def active(self) -> bool:
+        return self._demand.is_set()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "open": self._stream is not None,
+            "open_time": self.open_time,
+            "error": self.error,
+            "frames": self.frames,
+            "idle_frames": self.idle_frames,
+            "unchanged": self.unchanged,
+            "renditions": {name: rendition_stats(broadcaster) for name, broadcaster in self.renditions.items()},
+            "recorders": [recorder.stats() for recorders in self.recorders.values() for recorder in recorders]
+        }
+
+    def stop(self) -> None:
+        self._stop.set()
+        # wake up a suspended capture loop
+        self._demand.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close()
+
+    def _changed(self, frame) -> bool:
+        """
+        compares a small grayscale copy of the frame with the last changed one,
+        every block of it averages many pixels, so sensor noise cancels out
+        while a small moving object still changes its block
+
+        returns:
+            True when any block differs by more than change_threshold
+        """
+        if not self.change_threshold:
+            return True
+        gray = self._gray[1] if self._reference is self._gray[0] else self._gray[0]
+        cv2.resize(frame, DETECTOR_SIZE, dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=gray)
+        if self._reference is not None:
+            cv2.absdiff(gray, self._reference, dst=self._difference)
+            if self._difference.max() <= self.change_threshold:
+                return False
+        self._reference = gray
+        return True
+
+    def _resize(self, frame: np.ndarray, rendition: str) -> np.ndarray:
+        # resized copy of the frame in a buffer of the rendition pool, height keeps the aspect ratio
+        height, width = frame.shape[:2]
+        target = self.widths[rendition] or width
+        size = (target, int(height * target / width))
+        resized = self.pools[rendition].get((size[1], size[0]) + frame.shape[2:])
+        if target == width:
+            np.copyto(resized, frame)
+        else:
+            cv2.resize(frame, size, dst=resized, interpolation=cv2.INTER_AREA)
+        return resized
+
+    def process(self, frame: np.ndarray, idle: bool = False, captured: Optional[float] = None) -> None:
+        """
+        change detection, resize, overlay and encoding of one captured frame
+        for every rendition that needs it, called by the capture thread
+
+        :param idle: keep-alive frame without subscribers
+        :param captured: capture time, acquisition.now() for None
+        """
+        if captured is None:
+            captured = now()
+        # grab the current timestamp
+        timestamp = datetime.datetime.now().strftime("%A %d %B %Y %I:%M:%S%p")
+
+        self.frames += 1
+        if idle:
+            self.idle_frames += 1
+        # the timestamp is drawn later, so it does not count as a change
+        changed = self._changed(frame)
+        if not changed:
+            self.unchanged += 1
+        for rendition, broadcaster in self.renditions.items():
+            recorders = self.recorders[rendition]
+            # unchanged frames are only sent as keep-alive, a new rendition gets one right away
+            publish = (broadcaster.wanted or idle and rendition == self.default) and \
+                (changed or idle or captured - self._published.get(rendition, 0.0) >= self.keepalive)
+            if not (publish or recorders):
                 continue
-            # encode the frame in JPEG format
-            flag, encoded_image = cv2.imencode(".jpg", output_frame_left)
-            # ensure the frame was successfully encoded
-            if not flag:
+            # resize the frame and draw the timestamp on it, the same size for every width
+            resized = self._resize(frame, rendition)
+            cv2.putText(resized, timestamp, (10, resized.shape[0] - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.35 * resized.shape[1] / 400, (0, 0, 255), 1)
+            for recorder in recorders:
+                recorder.write(resized, captured)
+            if publish:
+                self._published[rendition] = captured
+                # encode the frame once for every client of the rendition
+                broadcaster.publish(resized)
+
+    def _idle_wait(self) -> bool:
+        """
+        waits for a subscriber, the next keep-alive frame or closes the camera
+        after idle_timeout
+
+        returns:
+            True when a keep-alive frame is due
+        """
+        deadlines = []
+        if self.idle_fps:
+            deadlines.append(self._used_at + 1.0 / self.idle_fps)
+        if self._stream is not None and self.idle_timeout:
+            deadlines.append(self._used_at + self.idle_timeout)
+        if self._demand.wait(max(0.0, min(deadlines) - time.monotonic()) if deadlines else None):
+            return False
+        current = time.monotonic()
+        if self._stream is not None and self.idle_timeout and current >= self._used_at + self.idle_timeout:
+            self._close()
+        return bool(self.idle_fps) and current >= self._used_at + 1.0 / self.idle_fps
+
+    def _capture(self) -> None:
+        period = 1.0 / self.fps if self.fps else 0.0
+        if self.preload:
+            self._ensure_open()
+            self._used_at = time.monotonic()
+        # loop over frames from the video stream
+        while not self._stop.is_set():
+            idle = False
+            if not self._demand.is_set():
+                # nobody is watching
+                if not self._idle_wait():
+                    continue
+                idle = True
+
+            # the first needed frame opens the camera
+            if not self._ensure_open():
                 continue
-        # yield the output frame in the byte format
-        yield b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n'
-
-
-
-# def make_photo_rigth():
-#     global vs_right, output_frame_right, lock_right
-#     total = 0
-#     # loop over frames from the video stream
-#     while True:
-#         # read the next frame from the video stream, resize it,
-#         # convert the frame to grayscale, and blur it
-#         frame = vs_right.read()
-#         frame = imutils.resize(frame, width=400)
-#         # grab the current timestamp and draw it on the frame
-#         timestamp = datetime.datetime.now()
-#         cv2.putText(frame, timestamp.strftime(
-#             "%A %d %B %Y %I:%M:%S%p"), (10, frame.shape[0] - 10),
-#             cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
-
-#         total += 1
-#         # acquire the lock, set the output frame, and release the
-#         # lock
-#         with lock_right:
-#             output_frame_right = frame.copy()
-
-#         if cv2.waitKey(1) & 0xFF == ord('q'):
-#             print('break')
-#             break
-
-
-# def generate_right():
-#     # grab global references to the output frame and lock variables
-#     global vs_right, output_frame_right, lock_right
-#     # loop over frames from the output stream
-
-#     while True:
-#         # wait until the lock is acquired
-#         with lock_right:
-#             # check if the output frame is available, otherwise skip
-#             # the iteration of the loop
-#             if output_frame_right is None:
-#                 continue
-#             # encode the frame in JPEG format
-#             flag, encoded_image = cv2.imencode(".jpg", output_frame_right)
-#             # ensure the frame was successfully encoded
-#             if not flag:
-#                 continue
-#         # yield the output frame in the byte format
-#         yield b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n'
+
+            started = time.monotonic()
+            # read the next frame from the video stream
+            frame = self._stream.read()
+            captured = now()
+            if frame is None:
+                self._stop.wait(0.1)
+                continue
+            if frame is self._frame:
+                # the camera is slower than fps, or fps is 0
+                self._stop.wait(self.FRAME_POLL_TIME)
+                continue
+            self._frame = frame
+            self._used_at = started
+            self.process(frame, idle, captured)
+
+            if period and not idle:
+                self._stop.wait(max(0.0, period - (time.monotonic() - started)))
+
+
+def rendition_stats(broadcaster: FrameBroadcaster) -> dict:
+    return {
+        "frames": broadcaster.sequence,
+        # size of the latest encoded frame in bytes
+        "frame_size": len(broadcaster.chunk) if broadcaster.chunk is not None else None,
+        "clients": broadcaster.clients,
+        "subscribers": broadcaster.subscribers,
+        "dropped": broadcaster.dropped,
+        "bytes_per_second": broadcaster.sent.rate(),
+        "bytes_sent": broadcaster.sent.total
+    }
+
+
+class CameraPool:
+    """
+    camera pipelines created from config, see config.cameras,
+    every camera is recorded when recording options are given, see config.recording,
+    and has a live WebM stream when live options are given, see config.live
+    """
+
+    def __init__(self, cameras: Dict[str, dict], recording: Optional[dict] = None,
+                 live: Optional[dict] = None) -> None:
+        # start() only starts the capture threads, cameras are opened by them
+        self.pipelines: Dict[str, CameraPipeline] = {
+            name: CameraPipeline(name, **options) for name, options in cameras.items()
+        }
+        self.recording = recording
+        self.recorders: list = []
+        # camera name -> LiveEncoder
+        self.live: dict = {}
+        if live:
+            from video_live import LiveEncoder
+            self.live = {name: LiveEncoder(pipeline, **live) for name, pipeline in self.pipelines.items()}
+
+    def __getitem__(self, name: str) -> CameraPipeline:
+        return self.pipelines[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.pipelines
+
+    def names(self) -> list:
+        return list(self.pipelines.keys())
+
+    def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        for pipeline in self.pipelines.values():
+            for broadcaster in pipeline.renditions.values():
+                broadcaster.attach(loop)
+        for encoder in self.live.values():
+            encoder.attach(loop)
+
+    def start(self) -> None:
+        for pipeline in self.pipelines.values():
+            pipeline.start()
+        if self.recording and not self.recorders:
+            from video_recorder import start_recording
+            self.recorders = [start_recording(pipeline, self.recording) for pipeline in self.pipelines.values()]
+
+    def stop(self) -> None:
+        for pipeline in self.pipelines.values():
+            pipeline.stop()
+        # after the capture, so recorders get every frame
+        for recorder in self.recorders:
+            recorder.stop()
+        self.recorders = []
+
+    def stats(self) -> dict:
+        stats = {name: pipeline.stats() for name, pipeline in self.pipelines.items()}
+        for name, encoder in self.live.items():
+            stats[name]["live"] = encoder.stats()
+        return stats